@@ -0,0 +1,353 @@
+"""
+Load test for the snuz backend.
+
+Creates users and groups, connects every user to /ws/{username}, then fires synchronized
+/to-sleep -> /to-snooze -> /to-awake storms and reports latency percentiles, requests per second and how long
+broadcasts take to reach every member of the group.
+
+By default a server is started on a throwaway SQLite database with the deterministic stub model, so two runs
+with the same arguments are comparable:
+
+    python loadtest.py --users 2000 --group-size 5 --rounds 3
+
+Point it at a running server (e.g. one backed by a local postgres) with --url instead.
+"""
+import argparse
+import asyncio
+from dataclasses import dataclass, field
+import datetime as dt
+import json
+import os
+from pathlib import Path
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional, Tuple
+import uuid
+
+import httpx
+import websockets
+
+
+FASTAPI_DIR = Path(__file__).resolve().parent.parent / "fastapi"
+STORM = ("to-sleep", "to-snooze", "to-awake")
+
+
+def percentile(values: List[float], q: float) -> float:
+    """
+    Nearest-rank percentile of already sorted values.
+    """
+    if not values:
+        return 0.0
+    index = max(0, min(len(values) - 1, int(round(q / 100 * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+def summarize(values: List[float]) -> dict:
+    values = sorted(values)
+    return {
+        "count": len(values),
+        "p50_ms": round(percentile(values, 50) * 1000, 2),
+        "p95_ms": round(percentile(values, 95) * 1000, 2),
+        "p99_ms": round(percentile(values, 99) * 1000, 2),
+        "max_ms": round(values[-1] * 1000, 2) if values else 0.0
+    }
+
+
+def check(response: httpx.Response):
+    if response.status_code != 200:
+        try:
+            detail = response.json().get("detail")
+        except ValueError:
+            detail = response.text
+        raise RuntimeError(f"{response.status_code} {detail}")
+
+
+@dataclass
+class Member:
+    username: str
+    group: int
+    websocket: Optional[object] = None
+    listener: Optional[asyncio.Task] = None
+
+
+@dataclass
+class Phase:
+    name: str
+    latencies: List[float] = field(default_factory=list)
+    errors: Dict[str, int] = field(default_factory=dict)
+    elapsed: float = 0.0
+
+    def report(self) -> dict:
+        succeeded = len(self.latencies)
+        return {
+            "phase": self.name,
+            **summarize(self.latencies),
+            "errors": sum(self.errors.values()),
+            "error_samples": dict(list(self.errors.items())[:5]),
+            "rps": round(succeeded / self.elapsed, 1) if self.elapsed else 0.0
+        }
+
+
+class LoadTest:
+    def __init__(self, url: str, args: argparse.Namespace):
+        self.url = url.rstrip("/")
+        self.ws_url = "ws" + self.url.removeprefix("http")
+        self.args = args
+        self.random = random.Random(args.seed)
+        self.members = [
+            Member(f"{args.prefix}{i}", i // args.group_size) for i in range(args.users)
+        ]
+        self.groups: Dict[int, List[Member]] = {}
+        for member in self.members:
+            self.groups.setdefault(member.group, []).append(member)
+        self.phases: List[Phase] = []
+        # (operation, username) -> when the request that triggers the broadcast was sent
+        self.sent: Dict[Tuple[str, str], float] = {}
+        self.fanout: Dict[str, List[float]] = {operation: [] for operation in STORM}
+        self.message_ready: List[float] = []
+        self.expected_deliveries: Dict[str, int] = {operation: 0 for operation in STORM}
+        self.limit = asyncio.Semaphore(args.concurrency)
+        self.client = httpx.AsyncClient(
+            base_url=self.url,
+            timeout=args.timeout,
+            limits=httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+        )
+
+    async def run(self) -> dict:
+        try:
+            await self.run_phase("create-user", self.members, self.create_user)
+            owners = [group[0] for group in self.groups.values()]
+            await self.run_phase("create-group", owners, self.create_group)
+            await self.run_phase("connect", self.members, self.connect)
+            for round_number in range(self.args.rounds):
+                for operation in STORM:
+                    self.sent.clear()
+                    await self.run_phase(f"{operation}#{round_number + 1}", self.members, self.storm(operation))
+                    await asyncio.sleep(self.args.settle)
+        finally:
+            await self.close()
+        return self.report()
+
+    async def run_phase(self, name: str, members: List[Member], action):
+        phase = Phase(name)
+        self.phases.append(phase)
+        order = list(members)
+        self.random.shuffle(order)
+        start = asyncio.Event()
+
+        async def one(member: Member):
+            await start.wait()
+            async with self.limit:
+                began = time.perf_counter()
+                try:
+                    await action(member)
+                    phase.latencies.append(time.perf_counter() - began)
+                except Exception as e:
+                    error = str(e)[:120] or type(e).__name__
+                    phase.errors[error] = phase.errors.get(error, 0) + 1
+
+        tasks = [asyncio.create_task(one(member)) for member in order]
+        await asyncio.sleep(0)  # let every task reach the barrier so the storm is synchronized
+        began = time.perf_counter()
+        start.set()
+        await asyncio.gather(*tasks)
+        phase.elapsed = time.perf_counter() - began
+        print(f"{name}: {len(phase.latencies)} ok, {sum(phase.errors.values())} failed in {phase.elapsed:.2f}s")
+
+    async def create_user(self, member: Member):
+        response = await self.client.post("/create-user", data={"username": member.username})
+        check(response)
+
+    async def create_group(self, owner: Member):
+        # far enough ahead that the scheduler leaves the groups alone, long enough that rounds never finish them
+        sleep_time = dt.datetime.now(dt.timezone.utc) + dt.timedelta(hours=2)
+        response = await self.client.post("/create-group", json={
+            "owner_username": owner.username,
+            "group_members": [member.username for member in self.groups[owner.group]],
+            "to_sleep_time": sleep_time.isoformat(),
+            "to_wake_up_time": (sleep_time + dt.timedelta(hours=8)).isoformat(),
+            "duration_days": 365,
+            "start_date": sleep_time.isoformat()
+        })
+        check(response)
+
+    async def connect(self, member: Member):
+        member.websocket = await websockets.connect(
+            f"{self.ws_url}/ws/{member.username}",
+            open_timeout=self.args.timeout,
+            max_size=None
+        )
+        member.listener = asyncio.create_task(self.listen(member))
+
+    def storm(self, operation: str):
+        async def fire(member: Member):
+            self.sent[(operation, member.username)] = time.perf_counter()
+            response = await self.client.post(f"/{operation}", data={"username": member.username})
+            check(response)
+            self.expected_deliveries[operation] += len(self.groups[member.group])
+        return fire
+
+    async def listen(self, member: Member):
+        try:
+            async for raw in member.websocket:
+                received = time.perf_counter()
+                try:
+                    message = json.loads(raw)
+                except ValueError:
+                    continue
+                operation = message.get("operation")
+                if operation == "message-ready":
+                    # generated text that followed a templated message, timed from its triggering request
+                    for key in ((o, message.get("username")) for o in STORM):
+                        if key in self.sent:
+                            self.message_ready.append(received - self.sent[key])
+                            break
+                elif (sent := self.sent.get((operation, message.get("username")))) is not None:
+                    self.fanout[operation].append(received - sent)
+        except websockets.ConnectionClosed:
+            pass
+
+    async def close(self):
+        for member in self.members:
+            if member.websocket is not None:
+                await member.websocket.close()
+            if member.listener is not None:
+                member.listener.cancel()
+        await self.client.aclose()
+
+    def report(self) -> dict:
+        fanout = {}
+        for operation, delays in self.fanout.items():
+            expected = self.expected_deliveries[operation]
+            fanout[operation] = {
+                **summarize(delays),
+                "expected": expected,
+                "delivered_ratio": round(len(delays) / expected, 4) if expected else 0.0
+            }
+        return {
+            "config": {
+                key: getattr(self.args, key)
+                for key in ("users", "group_size", "rounds", "concurrency", "seed", "model", "database_url", "url")
+            },
+            "phases": [phase.report() for phase in self.phases],
+            "fanout": fanout,
+            "message_ready": summarize(self.message_ready)
+        }
+
+
+def print_report(report: dict):
+    header = f"{'phase':<16}{'ok':>8}{'errors':>8}{'rps':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}"
+    print()
+    print(header)
+    print("-" * len(header))
+    for phase in report["phases"]:
+        print(
+            f"{phase['phase']:<16}{phase['count']:>8}{phase['errors']:>8}{phase['rps']:>10}"
+            f"{phase['p50_ms']:>10}{phase['p95_ms']:>10}{phase['p99_ms']:>10}{phase['max_ms']:>10}"
+        )
+
+    header = f"{'fan-out':<16}{'delivered':>10}{'expected':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}"
+    print()
+    print(header)
+    print("-" * len(header))
+    rows = list(report["fanout"].items())
+    rows.append(("message-ready", {**report["message_ready"], "expected": "-"}))
+    for name, row in rows:
+        print(
+            f"{name:<16}{row['count']:>10}{row['expected']:>10}"
+            f"{row['p50_ms']:>10}{row['p95_ms']:>10}{row['p99_ms']:>10}{row['max_ms']:>10}"
+        )
+
+
+async def wait_until_ready(url: str, server: subprocess.Popen, timeout: float = 120):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(base_url=url, timeout=2) as client:
+        while time.monotonic() < deadline:
+            if server.poll() is not None:
+                raise RuntimeError(f"server exited with code {server.returncode}")
+            try:
+                if (await client.get("/")).status_code == 200:
+                    return
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.25)
+    raise RuntimeError(f"server did not come up within {timeout}s")
+
+
+def start_server(args: argparse.Namespace, workdir: str) -> Tuple[subprocess.Popen, str]:
+    env = {
+        **os.environ,
+        "DATABASE_URL": args.database_url or f"sqlite+aiosqlite:///{workdir}/bench.db",
+        "MODEL_BACKEND": args.model,
+        "MODEL_STUB_LATENCY": str(args.stub_latency),
+        "BROADCAST_BACKEND": "local" if args.workers == 1 else "postgres"
+    }
+    log_path = os.path.join(workdir, "server.log")
+    command = [
+        sys.executable, "-m", "uvicorn", "main:app",
+        "--host", "127.0.0.1",
+        "--port", str(args.port),
+        "--workers", str(args.workers),
+        "--log-level", "warning"
+    ]
+    with open(log_path, "w") as log_file:
+        server = subprocess.Popen(command, cwd=FASTAPI_DIR, env=env, stdout=log_file, stderr=subprocess.STDOUT)
+    print(f"started server on port {args.port}, logging to {log_path}")
+    return server, f"http://127.0.0.1:{args.port}"
+
+
+def raise_open_file_limit():
+    # every simulated user holds a websocket and the server side needs one descriptor per socket as well
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+async def main(args: argparse.Namespace) -> dict:
+    raise_open_file_limit()
+    server = None
+    workdir = tempfile.mkdtemp(prefix="snuz-bench-")
+    url = args.url
+    try:
+        if url is None:
+            server, url = start_server(args, workdir)
+            await wait_until_ready(url, server)
+        report = await LoadTest(url, args).run()
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait(timeout=30)
+
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as output:
+            json.dump(report, output, indent=2)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="benchmark a running server instead of starting one")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--group-size", type=int, default=5)
+    parser.add_argument("--rounds", type=int, default=1, help="sleep, snooze and awake storms to run")
+    parser.add_argument("--concurrency", type=int, default=200, help="requests in flight at once")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--settle", type=float, default=1, help="seconds to wait for broadcasts after each storm")
+    parser.add_argument("--seed", type=int, default=0, help="seeds the order users fire in")
+    parser.add_argument("--prefix", default=None, help="alphanumeric username prefix, random by default so reruns do not clash")
+    parser.add_argument("--json", help="also write the report to this file")
+    server_options = parser.add_argument_group("started server")
+    server_options.add_argument("--port", type=int, default=8765)
+    server_options.add_argument("--workers", type=int, default=1, help="more than one needs a postgres database")
+    server_options.add_argument("--database-url", help="defaults to a fresh SQLite file")
+    server_options.add_argument("--model", default="stub", help="MODEL_BACKEND of the started server")
+    server_options.add_argument("--stub-latency", type=float, default=0.05, help="seconds per stub model batch")
+    args = parser.parse_args()
+    if args.prefix is None:
+        args.prefix = f"bench{uuid.uuid4().hex[:6]}"
+    asyncio.run(main(args))
@@ -0,0 +1,102 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Dict, Hashable, Optional, TypeVar
+
+from caching import TTLCache
+
+
+log = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class GenerationBudget:
+    """
+    Bounds how many messages are being generated at once and how long each may take.
+
+    Callers take a slot with try_acquire before starting any work and fall back to a templated message when none
+    is free, so a burst of alarms never queues up behind the model. `run` gives the slot back when it is done.
+    """
+
+    def __init__(self, max_concurrent: int = 8, deadline: float = 2):
+        self.max_concurrent = max_concurrent
+        self.deadline = deadline
+        self.in_flight = 0
+        self.admitted = 0
+        self.shed = 0
+        self.timed_out = 0
+        self.failed = 0
+
+    def try_acquire(self) -> bool:
+        if self.in_flight >= self.max_concurrent:
+            self.shed += 1
+            return False
+        self.in_flight += 1
+        self.admitted += 1
+        return True
+
+    def release(self):
+        self.in_flight -= 1
+
+    async def run(self, awaitable: Awaitable[T]) -> Optional[T]:
+        """
+        Await generation within the deadline on an acquired slot, returns None when it timed out or failed.
+        """
+        try:
+            return await asyncio.wait_for(awaitable, self.deadline)
+        except asyncio.TimeoutError:
+            self.timed_out += 1
+            return None
+        except Exception as e:
+            self.failed += 1
+            log.error(f"message generation failed, using the template instead: {e}")
+            return None
+        finally:
+            self.release()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "max_concurrent": self.max_concurrent,
+            "in_flight": self.in_flight,
+            "admitted": self.admitted,
+            "shed": self.shed,
+            "timed_out": self.timed_out,
+            "failed": self.failed,
+            # every message answered with the template because of the budget
+            "degraded": self.shed + self.timed_out + self.failed
+        }
+
+
+class RateLimiter:
+    """
+    Token bucket per key: `burst` requests at once, refilled at `per_minute` requests a minute.
+
+    Buckets that would be full again are forgotten, so only recently active keys take memory.
+    """
+
+    def __init__(self, per_minute: float, burst: Optional[float] = None, maxsize: int = 100000):
+        self.rate = per_minute / 60
+        self.burst = per_minute if burst is None else burst
+        self.limited = 0
+        self._buckets = TTLCache(maxsize, self.burst / self.rate if self.rate > 0 else 0)
+
+    @property
+    def enabled(self) -> bool:
+        return self.rate > 0
+
+    def hit(self, key: Hashable) -> float:
+        """
+        Take a token for `key`, returns 0 when allowed or the seconds until the next token otherwise.
+        """
+        if not self.enabled:
+            return 0
+        now = time.monotonic()
+        tokens, updated = self._buckets.peek(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        if tokens < 1:
+            self.limited += 1
+            self._buckets.set(key, (tokens, now))
+            return (1 - tokens) / self.rate
+        self._buckets.set(key, (tokens - 1, now))
+        return 0
@@ -0,0 +1,112 @@
+from typing import Dict, List, Sequence
+
+import numpy as np
+
+
+MINUTES_PER_DAY = 24 * 60
+
+
+def rolling_mean(values: np.ndarray, window: int) -> np.ndarray:
+    """
+    Mean of every complete `window` of consecutive values, from one cumulative sum.
+    """
+    if window <= 0 or len(values) < window:
+        return np.empty(0)
+    sums = np.cumsum(np.concatenate(([0.0], values.astype(float))))
+    return (sums[window:] - sums[:-window]) / window
+
+
+def minutes_from_noon(times: np.ndarray) -> np.ndarray:
+    """
+    Time of day of datetime64 values as minutes since noon, so bedtimes on either side of midnight stay close.
+    """
+    minutes = (times.astype("datetime64[m]") - times.astype("datetime64[D]")).astype(np.int64)
+    return (minutes - MINUTES_PER_DAY // 2) % MINUTES_PER_DAY
+
+
+def clock_of(minutes_since_noon: float) -> str:
+    minutes = int(round(minutes_since_noon + MINUTES_PER_DAY // 2)) % MINUTES_PER_DAY
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+
+def user_report(
+    slept_at: np.ndarray,
+    woke_at: np.ndarray,
+    minutes_slept: np.ndarray,
+    snoozes: np.ndarray,
+    window: int
+) -> dict:
+    """
+    Trends over a user's recent nights, oldest first.
+    """
+    nights = len(minutes_slept)
+    if not nights:
+        return {"nights": 0}
+
+    bedtimes = minutes_from_noon(slept_at)
+    wake_times = minutes_from_noon(woke_at)
+    return {
+        "nights": nights,
+        "dates": np.datetime_as_string(woke_at.astype("datetime64[D]")).tolist(),
+        "minutes_slept": minutes_slept.tolist(),
+        "rolling_minutes_slept": np.round(rolling_mean(minutes_slept, window), 1).tolist(),
+        "average_minutes_slept": round(float(minutes_slept.mean()), 1),
+        "consistency": {
+            # standard deviations in minutes, lower is more regular
+            "bedtime_std_minutes": round(float(bedtimes.std()), 1),
+            "wake_time_std_minutes": round(float(wake_times.std()), 1),
+            "duration_std_minutes": round(float(minutes_slept.std()), 1),
+            "average_bedtime": clock_of(float(bedtimes.mean())),
+            "average_wake_time": clock_of(float(wake_times.mean()))
+        },
+        "snoozes": {
+            "per_night": round(float(snoozes.mean()), 2),
+            "nights_snoozed_rate": round(float((snoozes > 0).mean()), 3),
+            "rolling_per_night": np.round(rolling_mean(snoozes, window), 2).tolist()
+        }
+    }
+
+
+def group_report(usernames: Sequence[str], totals: np.ndarray) -> dict:
+    """
+    Compare group members from their running totals.
+
+    `totals` has one row per member with columns nights, total minutes, total minutes squared, total snoozes and
+    nights snoozed. Members without any recorded nights are listed with null figures.
+    """
+    if not len(usernames):
+        return {"members": []}
+    nights, minutes, minutes_squared, total_snoozes, nights_snoozed = totals.astype(float).T
+    with np.errstate(divide="ignore", invalid="ignore"):
+        average = minutes / nights
+        std = np.sqrt(np.maximum(minutes_squared / nights - average ** 2, 0))
+        snooze_rate = total_snoozes / nights
+        snoozed_rate = nights_snoozed / nights
+
+    tracked = nights > 0
+    group_average = float(average[tracked].mean()) if tracked.any() else None
+    # rank 1 sleeps the most on average, untracked members are not ranked
+    order = np.argsort(-np.where(tracked, average, -np.inf), kind="stable")
+    ranks = np.empty(len(usernames), dtype=np.int64)
+    ranks[order] = np.arange(1, len(usernames) + 1)
+
+    members: List[Dict] = []
+    for i, username in enumerate(usernames):
+        if not tracked[i]:
+            members.append({"username": username, "nights": 0, "rank": None})
+            continue
+        members.append({
+            "username": username,
+            "nights": int(nights[i]),
+            "rank": int(ranks[i]),
+            "average_minutes_slept": round(float(average[i]), 1),
+            "duration_std_minutes": round(float(std[i]), 1),
+            "vs_group_minutes": round(float(average[i] - group_average), 1),
+            "snoozes_per_night": round(float(snooze_rate[i]), 2),
+            "nights_snoozed_rate": round(float(snoozed_rate[i]), 3)
+        })
+    return {
+        "average_minutes_slept": None if group_average is None else round(group_average, 1),
+        "snoozes_per_night": round(float(total_snoozes[tracked].sum() / nights[tracked].sum()), 2) if tracked.any() else None,
+        "members": members
+    }
@@ -0,0 +1,313 @@
+import asyncio
+from dataclasses import dataclass, replace
+import json
+import logging
+from typing import Awaitable, Callable, List, Optional, Set
+import uuid
+
+from fastapi import WebSocket, status
+
+
+log = logging.getLogger(__name__)
+
+# postgres rejects NOTIFY payloads of 8000 bytes or more
+MAX_NOTIFY_PAYLOAD = 7999
+
+Handler = Callable[[str, str], Awaitable[None]]
+
+
+@dataclass
+class BroadcastMessage:
+    operation: str
+    username: str
+    data: dict
+    # what changed about who is asleep, see presence.PresenceTracker
+    presence: Optional[dict] = None
+
+    def to_string(self):
+        envelope = {
+            "operation": self.operation,
+            "username": self.username,
+            "message": self.data
+        }
+        if self.presence is not None:
+            envelope["presence"] = self.presence
+        return json.dumps(envelope)
+
+    def split(self, key: str, fits: Callable[[str], bool]) -> List["BroadcastMessage"]:
+        """
+        Spread the list in `data[key]` over as many messages as it takes for each to satisfy `fits`. Split messages
+        are numbered with `part` and `parts`, and only the last one carries the presence delta so it is applied once,
+        after everything it summarizes.
+        """
+        if fits(self.to_string()):
+            return [self]
+        items = self.data[key]
+        # measured with the largest numbers a part could get
+        numbered = {**self.data, "part": len(items), "parts": len(items)}
+        chunks = []
+        start = 0
+        while start < len(items):
+            # the longest run from `start` that fits, a single item that does not is sent on its own
+            low, high = start + 1, len(items)
+            while low < high:
+                middle = (low + high + 1) // 2
+                if fits(replace(self, data={**numbered, key: items[start:middle]}).to_string()):
+                    low = middle
+                else:
+                    high = middle - 1
+            chunks.append(items[start:low])
+            start = low
+        return [
+            replace(
+                self,
+                data={**self.data, key: chunk, "part": index + 1, "parts": len(chunks)},
+                presence=self.presence if index == len(chunks) - 1 else None
+            )
+            for index, chunk in enumerate(chunks)
+        ]
+
+
+class BroadcastBus:
+    """
+    Carries group broadcasts to every node that may hold websockets for the group.
+
+    This base implementation is in-process only: a published payload goes straight to the local handler. Cross
+    process buses deliver locally first and then forward the payload to the other nodes.
+    """
+
+    def __init__(self):
+        self._handler: Optional[Handler] = None
+
+    def subscribe(self, handler: Handler):
+        """
+        Set the coroutine called with (group_id, payload) for every broadcast that reaches this node.
+        """
+        self._handler = handler
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def publish(self, group_id: str, payload: str):
+        await self._deliver(group_id, payload)
+
+    def fits(self, group_id: str, payload: str) -> bool:
+        """
+        Whether a payload for the group can reach every node, large messages should be split until it does.
+        """
+        return True
+
+    async def _deliver(self, group_id: str, payload: str):
+        if self._handler is None:
+            return
+        try:
+            await self._handler(group_id, payload)
+        except Exception as e:
+            log.error(f"failed to deliver broadcast to group {group_id}: {e}")
+
+
+class PostgresBroadcastBus(BroadcastBus):
+    """
+    Fans broadcasts out between workers and replicas with Postgres LISTEN/NOTIFY on a dedicated connection.
+    """
+
+    CHANNEL = "snuz_broadcast"
+
+    def __init__(self, dsn: str, ssl: Optional[str] = None):
+        super().__init__()
+        self.dsn = dsn
+        self.ssl = ssl
+        self.node_id = str(uuid.uuid4())
+        self._connection = None
+        self._connect_lock = asyncio.Lock()
+        # asyncpg runs one operation at a time per connection, concurrent publishes wait their turn
+        self._notify_lock = asyncio.Lock()
+        # the event loop only keeps weak references to tasks, these are started from asyncpg callbacks
+        self._tasks: Set[asyncio.Task] = set()
+
+    async def start(self):
+        await self._connect()
+
+    async def stop(self):
+        if self._connection is not None:
+            await self._connection.close()
+            self._connection = None
+
+    async def publish(self, group_id: str, payload: str):
+        await self._deliver(group_id, payload)
+
+        if not self.fits(group_id, payload):
+            log.error(f"broadcast to group {group_id} is too large to forward to other nodes")
+            return
+        notification = self._notification(group_id, payload)
+        try:
+            async with self._notify_lock:
+                connection = await self._connect()
+                await connection.execute("SELECT pg_notify($1, $2)", self.CHANNEL, notification)
+        except Exception as e:
+            log.error(f"failed to forward broadcast to other nodes: {e}")
+
+    def fits(self, group_id: str, payload: str) -> bool:
+        return len(self._notification(group_id, payload).encode()) <= MAX_NOTIFY_PAYLOAD
+
+    def _notification(self, group_id: str, payload: str) -> str:
+        return json.dumps({"node": self.node_id, "group_id": group_id, "payload": payload})
+
+    async def _connect(self):
+        # asyncpg is only needed when this bus is actually used
+        import asyncpg
+
+        async with self._connect_lock:
+            if self._connection is None or self._connection.is_closed():
+                self._connection = await asyncpg.connect(self.dsn, ssl=self.ssl)
+                await self._connection.add_listener(self.CHANNEL, self._on_notify)
+                self._connection.add_termination_listener(self._on_terminate)
+            return self._connection
+
+    def _on_notify(self, connection, pid: int, channel: str, notification: str):
+        message = json.loads(notification)
+        if message["node"] == self.node_id:  # already delivered locally
+            return
+        self._spawn(self._deliver(message["group_id"], message["payload"]))
+
+    def _on_terminate(self, connection):
+        log.warning("lost the broadcast listener connection, reconnecting")
+        self._connection = None
+        self._spawn(self._reconnect())
+
+    def _spawn(self, coroutine: Awaitable[None]):
+        task = asyncio.ensure_future(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _reconnect(self):
+        delay = 0.5
+        while True:
+            try:
+                await self._connect()
+                return
+            except Exception as e:
+                log.error(f"failed to reconnect the broadcast listener: {e}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 30)
+
+
+def create_bus(backend: str, dsn: Optional[str] = None, ssl: Optional[str] = None) -> BroadcastBus:
+    if backend == "local":
+        return BroadcastBus()
+    if backend == "postgres":
+        return PostgresBroadcastBus(dsn, ssl=ssl)
+    raise ValueError(f"Unknown broadcast backend {backend}, expected local or postgres")
+
+
+class GroupConnection:
+    """
+    One websocket in a group with its own bounded outbound queue, drained by a sender task.
+
+    Broadcasts only enqueue, so a slow client never holds up the rest of the group. When the queue is full the
+    connection is either dropped or, with `coalesce`, loses its oldest pending message to make room.
+    """
+
+    def __init__(
+        self,
+        websocket: WebSocket,
+        on_close: Callable[["GroupConnection"], None],
+        queue_size: int = 64,
+        send_timeout: float = 5,
+        coalesce: bool = False
+    ):
+        self.websocket = websocket
+        self.on_close = on_close
+        self.send_timeout = send_timeout
+        self.coalesce = coalesce
+        self.dropped_messages = 0
+        self.closed = False
+        self._closer: Optional[asyncio.Task] = None
+        self._queue: "asyncio.Queue[str]" = asyncio.Queue(maxsize=queue_size)
+        self._sender = asyncio.create_task(self._send_loop())
+
+    def offer(self, payload: str) -> bool:
+        """
+        Queue a payload without waiting, returns False if the connection could not keep up and was closed.
+        """
+        if self.closed:
+            return False
+        try:
+            self._queue.put_nowait(payload)
+            return True
+        except asyncio.QueueFull:
+            if not self.coalesce:
+                log.warning("dropping a websocket whose send queue overflowed")
+                self._closer = asyncio.create_task(self.close(status.WS_1013_TRY_AGAIN_LATER))
+                return False
+        self._queue.get_nowait()
+        self._queue.put_nowait(payload)
+        self.dropped_messages += 1
+        return True
+
+    async def close(self, code: int = status.WS_1000_NORMAL_CLOSURE):
+        if self.closed:
+            return
+        self.closed = True
+        self.on_close(self)
+        if self._sender is not asyncio.current_task():
+            self._sender.cancel()
+        try:
+            await self.websocket.close(code)
+        except Exception:
+            pass  # already gone
+
+    async def _send_loop(self):
+        while True:
+            payload = await self._queue.get()
+            try:
+                await asyncio.wait_for(self.websocket.send_text(payload), self.send_timeout)
+            except Exception as e:
+                log.info(f"closing websocket after a failed send: {e!r}")
+                await self.close(status.WS_1011_INTERNAL_ERROR)
+                return
+
+
+class GroupWebSocket:
+    def __init__(
+        self,
+        room_id,
+        bus: BroadcastBus,
+        queue_size: int = 64,
+        send_timeout: float = 5,
+        coalesce: bool = False
+    ):
+        self.room_id = room_id
+        self.bus = bus
+        self.queue_size = queue_size
+        self.send_timeout = send_timeout
+        self.coalesce = coalesce
+        self.connections: List[GroupConnection] = []
+
+    def connect(self, websocket: WebSocket) -> GroupConnection:
+        connection = GroupConnection(
+            websocket,
+            self._remove,
+            queue_size=self.queue_size,
+            send_timeout=self.send_timeout,
+            coalesce=self.coalesce
+        )
+        self.connections.append(connection)
+        return connection
+
+    async def disconnect(self, connection: GroupConnection):
+        await connection.close()
+
+    async def deliver(self, payload: str):
+        """
+        Queue an already serialized broadcast on every connection held by this node.
+        """
+        for connection in list(self.connections):
+            connection.offer(payload)
+
+    def _remove(self, connection: GroupConnection):
+        if connection in self.connections:
+            self.connections.remove(connection)
@@ -0,0 +1,176 @@
+import asyncio
+import logging
+import os
+from typing import Optional
+import uuid
+
+from dotenv import load_dotenv
+from sqlalchemy import BigInteger, Boolean, Column, Date, DateTime, ForeignKey, Index, Integer, String, Table, event, make_url, select, text
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import declarative_base, relationship, joinedload
+
+from metrics import stage
+
+
+MAX_SCORE = 100
+MIN_SCORE = 0
+
+log = logging.getLogger(__name__)
+
+
+##################
+# DATABASE SETUP #
+##################
+
+Base = declarative_base()
+load_dotenv()
+
+
+user_group_association = Table(
+    'user_group_association', Base.metadata,
+    Column('user_id', String, ForeignKey('users.username'), primary_key=True),
+    Column('group_id', String, ForeignKey('groups.group_id'), primary_key=True)
+)
+
+
+class UserModel(Base):
+    __tablename__ = 'users'
+    username = Column(String, primary_key=True, nullable=False)
+    owns_a_group = Column(Boolean, nullable=False, default=False)
+
+    score = Column(Integer, nullable=False, default=MAX_SCORE)
+    average_minutes_slept = Column(Integer, nullable=True)
+    is_asleep = Column(Boolean, nullable=False, default=False)
+    last_sleep_time = Column(DateTime, nullable=True)
+    last_awake_time = Column(DateTime, nullable=True)
+    current_snooze_counter = Column(Integer, nullable=False, default=0)
+
+    groups = relationship('GroupModel', secondary=user_group_association, back_populates='users')
+
+class GroupModel(Base):
+    __tablename__ = 'groups'
+    group_id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()), nullable=False)
+    owner_username = Column(String, ForeignKey('users.username'), nullable=True)
+    to_sleep_time = Column(DateTime, nullable=False)
+    to_wake_up_time = Column(DateTime, nullable=False)
+    duration_days = Column(Integer, nullable=False)
+    days_remaining = Column(Integer, nullable=False)
+    start_date = Column(Date, nullable=False)
+
+    users = relationship('UserModel', secondary=user_group_association, back_populates='groups')
+
+# events applied through /sync-events, a replayed idempotency key is ignored
+class SyncEventModel(Base):
+    __tablename__ = 'sync_events'
+    username = Column(String, ForeignKey('users.username'), primary_key=True, nullable=False)
+    idempotency_key = Column(String, primary_key=True, nullable=False)
+    operation = Column(String, nullable=False)
+    occurred_at = Column(DateTime, nullable=False)
+    received_at = Column(DateTime, nullable=False)
+
+
+# one row per night, appended when the user wakes up and never updated
+class SleepSessionModel(Base):
+    __tablename__ = 'sleep_sessions'
+    __table_args__ = (Index('ix_sleep_sessions_username_woke_at', 'username', 'woke_at'),)
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    username = Column(String, ForeignKey('users.username'), nullable=False)
+    group_id = Column(String, nullable=True)  # groups are deleted once their challenge ends
+    slept_at = Column(DateTime, nullable=False)
+    woke_at = Column(DateTime, nullable=False)
+    minutes_slept = Column(Integer, nullable=False)
+    snoozes = Column(Integer, nullable=False)
+    sleep_goal = Column(DateTime, nullable=True)
+    wake_goal = Column(DateTime, nullable=True)
+
+# running totals over a user's sleep sessions, updated with every batch of new sessions
+class SleepStatsModel(Base):
+    __tablename__ = 'sleep_stats'
+    username = Column(String, ForeignKey('users.username'), primary_key=True, nullable=False)
+    nights = Column(Integer, nullable=False, default=0)
+    total_minutes = Column(BigInteger, nullable=False, default=0)
+    total_minutes_squared = Column(BigInteger, nullable=False, default=0)
+    total_snoozes = Column(Integer, nullable=False, default=0)
+    nights_snoozed = Column(Integer, nullable=False, default=0)
+
+
+user = os.getenv("user")
+password = os.getenv("password")
+host = os.getenv("host")
+dbname = os.getenv("dbname")
+
+# DATABASE_URL points the app at another database, e.g. a local postgres or sqlite+aiosqlite:///snuz.db
+DATABASE_URL = os.getenv("DATABASE_URL") or f"postgresql+asyncpg://{user}:{password}@{host}:5432/{dbname}"
+DB_SSL = os.getenv("DB_SSL", "require")
+IS_SQLITE = make_url(DATABASE_URL).get_backend_name() == "sqlite"
+
+# pool tuning, the database is remote so keep enough connections around to overlap slow round trips
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+# connections opened at startup so the first requests do not pay for the TLS handshakes
+DB_POOL_WARM = int(os.getenv("DB_POOL_WARM", str(DB_POOL_SIZE)))
+
+engine = create_async_engine(
+    DATABASE_URL,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_timeout=DB_POOL_TIMEOUT,
+    pool_recycle=DB_POOL_RECYCLE,
+    pool_pre_ping=DB_POOL_PRE_PING,
+    connect_args={} if IS_SQLITE else {"ssl": DB_SSL}
+)
+
+if IS_SQLITE:
+    @event.listens_for(engine.sync_engine, "connect")
+    def _configure_sqlite(connection, _):
+        # readers no longer block the writer, and concurrent writers wait for the lock instead of failing
+        cursor = connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA busy_timeout=30000")
+        cursor.close()
+# objects stay readable after commit, lazy refreshes are not possible under asyncio
+SessionLocal = async_sessionmaker(engine, autoflush=False, expire_on_commit=False)
+
+
+async def init_db():
+    """
+    Create any missing tables and make sure the database is reachable.
+    """
+    try:
+        async with engine.begin() as connection:
+            await connection.run_sync(Base.metadata.create_all)
+            await connection.execute(text("SELECT 1"))
+        log.debug("connection successful!")
+    except Exception as e:
+        log.critical(f"failed to connect: {e}")
+        raise e
+
+
+async def warm_pool(connections: int = DB_POOL_WARM) -> int:
+    """
+    Open up to `connections` pool connections at once and hand them back to the pool, returns how many opened.
+    A database that is slow to accept them only makes startup slower, failures are left to the schema check.
+    """
+    connections = min(connections, DB_POOL_SIZE)
+    if connections <= 0:
+        return 0
+    opened = await asyncio.gather(*(engine.connect().start() for _ in range(connections)), return_exceptions=True)
+    warmed = [connection for connection in opened if not isinstance(connection, BaseException)]
+    for connection in warmed:
+        await connection.close()
+    if len(warmed) < connections:
+        log.warning(f"warmed {len(warmed)} of {connections} database connections")
+    return len(warmed)
+
+
+async def find_user(db: AsyncSession, username: str) -> Optional[UserModel]:
+    with stage("find_user"):
+        result = await db.execute(
+            select(UserModel)
+            .options(joinedload(UserModel.groups).joinedload(GroupModel.users))
+            .filter(UserModel.username == username)
+        )
+        return result.unique().scalar_one_or_none()
@@ -0,0 +1,95 @@
+from dataclasses import dataclass, field
+import datetime as dt
+from typing import Dict, List, Sequence
+import uuid
+
+from sqlalchemy import insert, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database import GroupModel, UserModel, user_group_association
+
+
+users = UserModel.__table__
+groups = GroupModel.__table__
+members = user_group_association
+
+
+@dataclass
+class GroupPlan:
+    """
+    A validated group waiting to be inserted, `usernames` includes the owner.
+    """
+    owner_username: str
+    usernames: List[str]
+    to_sleep_time: dt.datetime
+    to_wake_up_time: dt.datetime
+    duration_days: int
+    start_date: dt.date
+    group_id: str = field(default_factory=lambda: str(uuid.uuid4()))
+
+
+async def membership_errors(db: AsyncSession, usernames: Sequence[List[str]]) -> List[List[str]]:
+    """
+    What stops each list of usernames from forming a new group, checked for every list with one query.
+
+    A username is rejected when the user does not exist, is already in a group, or is claimed by an earlier list.
+
+    The user rows are locked until the caller's transaction ends, in username order so that overlapping requests
+    cannot deadlock, and a request that had to wait checks membership only once the other one has committed.
+    """
+    wanted = {username for names in usernames for username in names}
+    found: Dict[str, bool] = {}
+    if wanted:
+        await db.execute(
+            select(users.c.username)
+            .where(users.c.username.in_(wanted))
+            .order_by(users.c.username)
+            .with_for_update()
+        )
+        # a separate statement so that it reads what the request holding the locks before us committed
+        rows = await db.execute(
+            select(users.c.username, members.c.group_id.is_not(None))
+            .outerjoin(members, members.c.user_id == users.c.username)
+            .where(users.c.username.in_(wanted))
+        )
+        for username, grouped in rows:
+            found[username] = found.get(username, False) or grouped
+
+    errors: List[List[str]] = []
+    claimed = set()
+    for names in usernames:
+        problems = []
+        for username in names:
+            if username not in found:
+                problems.append(f"Member does not exist: {username}")
+            elif found[username]:
+                problems.append(f"{username} is already a member of another group")
+            elif username in claimed:
+                problems.append(f"{username} is a member of more than one new group")
+        claimed.update(names)
+        errors.append(problems)
+    return errors
+
+
+async def insert_groups(db: AsyncSession, plans: Sequence[GroupPlan]):
+    """
+    Add every planned group and its memberships with one multi-row insert each, the caller commits.
+    """
+    if not plans:
+        return
+    await db.execute(insert(groups), [
+        {
+            "group_id": plan.group_id,
+            "owner_username": plan.owner_username,
+            "to_sleep_time": plan.to_sleep_time,
+            "to_wake_up_time": plan.to_wake_up_time,
+            "duration_days": plan.duration_days,
+            "days_remaining": plan.duration_days,
+            "start_date": plan.start_date
+        }
+        for plan in plans
+    ])
+    await db.execute(insert(members), [
+        {"user_id": username, "group_id": plan.group_id}
+        for plan in plans for username in plan.usernames
+    ])
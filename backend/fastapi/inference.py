@@ -0,0 +1,288 @@
+import asyncio
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+import logging
+import os
+import queue
+import resource
+import sys
+import threading
+import time
+import zlib
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from metrics import STAGE_SECONDS
+
+
+log = logging.getLogger(__name__)
+
+BATCH_WINDOW_SECONDS = 0.025
+MAX_BATCH_SIZE = 16
+
+# "<model>" loads the fp32 model, "<model>-int8" dynamically quantizes its transformer blocks,
+# "none" skips the model and answers with the prompt template only,
+# "stub" appends a canned continuation after MODEL_STUB_LATENCY seconds per batch, for benchmarks
+MODEL_BACKENDS = ("gpt2", "distilgpt2", "gpt2-int8", "distilgpt2-int8", "none", "stub")
+
+MODEL_STUB_LATENCY = float(os.getenv("MODEL_STUB_LATENCY", "0"))
+STUB_CONTINUATIONS = (
+    " and the bear nodded approvingly.",
+    " while the rest of the den kept snoring.",
+    " so the bear grumbled and rolled over.",
+    " and nobody was surprised."
+)
+
+
+def template_generator(prompts: List[str], **kwargs) -> List[List[dict]]:
+    """
+    Stand-in for the text-generation pipeline that returns every prompt unchanged.
+    """
+    return [[{"generated_text": prompt}] for prompt in prompts]
+
+
+def stub_generator(prompts: List[str], **kwargs) -> List[List[dict]]:
+    """
+    Deterministic stand-in for the model: the same prompt always gets the same continuation, and each batch takes
+    MODEL_STUB_LATENCY seconds like one batched forward pass would.
+    """
+    if MODEL_STUB_LATENCY > 0:
+        time.sleep(MODEL_STUB_LATENCY)
+    return [
+        [{"generated_text": prompt + STUB_CONTINUATIONS[zlib.crc32(prompt.encode()) % len(STUB_CONTINUATIONS)]}]
+        for prompt in prompts
+    ]
+
+
+def load_generator(backend: str) -> Tuple[Callable, Dict[str, Any]]:
+    """
+    Build the text-generation callable for `backend` and report what loading it cost.
+    """
+    if backend not in MODEL_BACKENDS:
+        raise ValueError(f"Unknown model backend {backend}, expected one of {', '.join(MODEL_BACKENDS)}")
+
+    stats = {"backend": backend, "load_seconds": 0.0, "rss_delta_mb": 0.0, "parameter_mb": 0.0}
+    if backend == "none":
+        return template_generator, stats
+    if backend == "stub":
+        return stub_generator, stats
+
+    # torch and transformers are only imported when a model is actually wanted
+    from transformers import pipeline
+
+    rss_before = _rss_bytes()
+    started = time.perf_counter()
+    model_name = backend.removesuffix("-int8")
+    generator = pipeline('text-generation', model=model_name)
+    generator.model.eval()
+    if backend.endswith("-int8"):
+        generator.model.transformer = _quantize(generator.model.transformer)
+
+    # gpt2 has no pad token, batching needs one
+    if generator.tokenizer.pad_token_id is None:
+        generator.tokenizer.pad_token_id = generator.model.config.eos_token_id
+        generator.tokenizer.padding_side = "left"
+
+    stats["load_seconds"] = round(time.perf_counter() - started, 3)
+    stats["rss_delta_mb"] = round((_rss_bytes() - rss_before) / 2**20, 1)
+    stats["parameter_mb"] = round(_parameter_bytes(generator.model) / 2**20, 1)
+    return generator, stats
+
+
+def _quantize(module):
+    """
+    Dynamically quantize the linear layers of `module` to int8.
+
+    GPT-2 implements its projections with transformers' Conv1D, which quantize_dynamic does not recognise, so
+    those are swapped for equivalent nn.Linear layers first.
+    """
+    import torch
+    from transformers.pytorch_utils import Conv1D
+
+    def to_linear(parent):
+        for name, child in parent.named_children():
+            if isinstance(child, Conv1D):
+                in_features, out_features = child.weight.shape
+                linear = torch.nn.Linear(in_features, out_features)
+                linear.weight.data = child.weight.data.t().contiguous()
+                linear.bias.data = child.bias.data
+                setattr(parent, name, linear)
+            else:
+                to_linear(child)
+
+    to_linear(module)
+    return torch.quantization.quantize_dynamic(module, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def _parameter_bytes(model) -> int:
+    tensors = list(model.parameters()) + list(model.buffers())
+    # quantized linear layers keep their packed weights outside of parameters()
+    for submodule in model.modules():
+        packed = getattr(submodule, "_packed_params", None)
+        if packed is not None and hasattr(packed, "_weight_bias"):
+            weight, bias = packed._weight_bias()
+            tensors.append(weight)
+            if bias is not None:
+                tensors.append(bias)
+    return sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+
+
+def _rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # peak rather than current, but the best available off linux (kilobytes on linux, bytes on macos)
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+@dataclass
+class InferenceRequest:
+    prompt: str
+    max_new_tokens: int
+    future: Future = field(default_factory=Future)
+
+
+class InferenceWorker:
+    """
+    Runs the text-generation pipeline on a dedicated thread so that a forward pass never blocks the event loop.
+
+    Prompts submitted within `batch_window` of each other are grouped into a single pipeline call (up to
+    `max_batch_size`), which is what keeps the top-of-the-hour alarm burst cheap.
+
+    The model for `backend` is loaded on the worker thread, right after start when `preload` is set or on the
+    first request otherwise, so the app can serve traffic before it is warm. If loading fails the worker falls
+    back to template-only messages.
+    """
+
+    def __init__(
+        self,
+        backend: str,
+        preload: bool = True,
+        batch_window: float = BATCH_WINDOW_SECONDS,
+        max_batch_size: int = MAX_BATCH_SIZE
+    ):
+        self.backend = backend
+        self.preload = preload
+        self.batch_window = batch_window
+        self.max_batch_size = max_batch_size
+        self.generator: Optional[Callable] = None
+        self.load_stats: Dict[str, Any] = {"backend": backend}
+        self._requests: "queue.Queue[Optional[InferenceRequest]]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def is_loaded(self) -> bool:
+        return self.generator is not None
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            **self.load_stats,
+            "requested_backend": self.backend,
+            "loaded": self.is_loaded,
+            "queue_depth": self.qsize()
+        }
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._run, name="inference-worker", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None):
+        if self._thread is None:
+            return
+        self._requests.put(None)
+        self._thread.join(timeout)
+        self._thread = None
+
+    def qsize(self) -> int:
+        return self._requests.qsize()
+
+    def submit(self, prompt: str, max_new_tokens: int = 25) -> Future:
+        request = InferenceRequest(prompt, max_new_tokens)
+        self._requests.put(request)
+        return request.future
+
+    async def generate(self, prompt: str, max_new_tokens: int = 25) -> str:
+        """
+        Queue a prompt and wait for its generated text without blocking the event loop.
+        """
+        return await asyncio.wrap_future(self.submit(prompt, max_new_tokens))
+
+    def _collect_batch(self, first: InferenceRequest) -> Tuple[List[InferenceRequest], bool]:
+        batch = [first]
+        deadline = time.monotonic() + self.batch_window
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                request = self._requests.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if request is None:
+                return batch, True
+            batch.append(request)
+        return batch, False
+
+    def _ensure_loaded(self):
+        if self.generator is not None:
+            return
+        try:
+            self.generator, self.load_stats = load_generator(self.backend)
+            log.info(
+                f"loaded model backend {self.backend} in {self.load_stats['load_seconds']}s "
+                f"(rss +{self.load_stats['rss_delta_mb']}MB, parameters {self.load_stats['parameter_mb']}MB)"
+            )
+        except Exception as e:
+            log.critical(f"failed to load model backend {self.backend}, using templates instead: {e}")
+            self.generator, self.load_stats = load_generator("none")
+            self.load_stats["error"] = str(e)
+
+    def _run(self):
+        if self.preload:
+            self._ensure_loaded()
+        stopping = False
+        while not stopping:
+            first = self._requests.get()
+            if first is None:
+                break
+            batch, stopping = self._collect_batch(first)
+
+            # pipeline kwargs apply to the whole call, so split by generation length
+            by_length: Dict[int, List[InferenceRequest]] = {}
+            for request in batch:
+                by_length.setdefault(request.max_new_tokens, []).append(request)
+
+            for max_new_tokens, requests in by_length.items():
+                self._run_batch(requests, max_new_tokens)
+
+    def _run_batch(self, requests: List[InferenceRequest], max_new_tokens: int):
+        # prompts whose caller gave up, e.g. past its deadline, are not worth a forward pass
+        requests = [request for request in requests if request.future.set_running_or_notify_cancel()]
+        if not requests:
+            return
+        self._ensure_loaded()
+        prompts = [request.prompt for request in requests]
+        started = time.perf_counter()
+        try:
+            results = self.generator(
+                prompts,
+                max_new_tokens=max_new_tokens,
+                num_return_sequences=1,
+                batch_size=len(prompts)
+            )
+        except Exception as e:
+            log.exception("generation failed for a batch of %d", len(prompts))
+            for request in requests:
+                if not request.future.done():
+                    request.future.set_exception(e)
+            return
+
+        elapsed = time.perf_counter() - started
+        STAGE_SECONDS.observe(elapsed, "model")
+        log.debug("generated %d messages in %.3fs", len(prompts), elapsed)
+        for request, result in zip(requests, results):
+            if not request.future.done():
+                request.future.set_result(result[0]["generated_text"])
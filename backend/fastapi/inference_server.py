@@ -0,0 +1,248 @@
+"""
+Standalone process that owns the message model and serves it to every uvicorn worker over a Unix socket.
+
+Run it with `python inference_server.py --socket /tmp/snuz-inference.sock --backend gpt2`, or let the app spawn
+it by setting INFERENCE_SOCKET and INFERENCE_SPAWN. Only one server can hold the socket's lock file, so any extra
+copies started by other workers exit straight away.
+
+The protocol is one JSON object per line in each direction:
+    {"id": 1, "prompt": "...", "max_new_tokens": 25}  ->  {"id": 1, "text": "..."} or {"id": 1, "error": "..."}
+    {"id": 2, "op": "status"}                          ->  {"id": 2, "status": {...}}
+    {"id": 1, "op": "cancel"}                          ->  nothing, request 1 is dropped before its forward pass
+"""
+import argparse
+import asyncio
+import fcntl
+import itertools
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+from typing import Any, Dict, Optional
+
+from inference import BATCH_WINDOW_SECONDS, MAX_BATCH_SIZE, InferenceWorker
+from logs import configure_logging
+
+
+log = logging.getLogger(__name__)
+
+STREAM_LIMIT = 2**20
+
+
+##########
+# SERVER #
+##########
+
+async def handle_connection(worker: InferenceWorker, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    write_lock = asyncio.Lock()
+    tasks: Dict[Any, asyncio.Task] = {}
+
+    async def respond(request: dict):
+        response: Dict[str, Any] = {"id": request.get("id")}
+        try:
+            if request.get("op") == "status":
+                response["status"] = worker.status()
+            else:
+                response["text"] = await worker.generate(request["prompt"], request.get("max_new_tokens", 25))
+        except Exception as e:
+            response["error"] = str(e)
+        async with write_lock:
+            writer.write((json.dumps(response) + "\n").encode())
+            await writer.drain()
+
+    try:
+        while line := await reader.readline():
+            request = json.loads(line)
+            request_id = request.get("id")
+            if request.get("op") == "cancel":
+                # the client gave up, cancelling the task takes the prompt out of the worker's next batch
+                if (task := tasks.get(request_id)) is not None:
+                    task.cancel()
+                continue
+            # every request gets its own task so the worker can batch prompts from all clients together
+            task = tasks[request_id] = asyncio.create_task(respond(request))
+            task.add_done_callback(lambda _, request_id=request_id: tasks.pop(request_id, None))
+    except (ConnectionError, json.JSONDecodeError) as e:
+        log.warning(f"dropping inference client: {e}")
+    finally:
+        for task in list(tasks.values()):
+            task.cancel()
+        writer.close()
+
+
+async def serve(socket_path: str, worker: InferenceWorker):
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    server = await asyncio.start_unix_server(
+        lambda reader, writer: handle_connection(worker, reader, writer),
+        path=socket_path,
+        limit=STREAM_LIMIT
+    )
+    log.info(f"inference server for {worker.backend} listening on {socket_path}")
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the snuz message model over a Unix socket")
+    parser.add_argument("--socket", default=os.getenv("INFERENCE_SOCKET", "/tmp/snuz-inference.sock"))
+    parser.add_argument("--backend", default=os.getenv("MODEL_BACKEND", "gpt2"))
+    parser.add_argument("--batch-window", type=float, default=BATCH_WINDOW_SECONDS)
+    parser.add_argument("--max-batch-size", type=int, default=MAX_BATCH_SIZE)
+    args = parser.parse_args()
+
+    configure_logging()
+
+    # the lock lives as long as this process, whoever holds it owns the socket
+    lock_file = open(args.socket + ".lock", "w")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        log.info(f"another inference server already owns {args.socket}")
+        return
+
+    worker = InferenceWorker(args.backend, batch_window=args.batch_window, max_batch_size=args.max_batch_size)
+    worker.start()
+    try:
+        asyncio.run(serve(args.socket, worker))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        worker.stop(timeout=5)
+
+
+##########
+# CLIENT #
+##########
+
+class InferenceClient:
+    """
+    Drop-in replacement for InferenceWorker that forwards prompts to an inference server.
+
+    All requests share one connection and are matched to their responses by id, so many handlers can wait on the
+    server at once, and a request whose caller gives up is cancelled on the server too. When `spawn` is set the
+    server is started as a child process if nobody is serving yet, and again if it went away with its worker.
+    """
+
+    def __init__(self, socket_path: str, backend: str, spawn: bool = False, connect_timeout: float = 120):
+        self.socket_path = socket_path
+        self.backend = backend
+        self.spawn = spawn
+        self.connect_timeout = connect_timeout
+        self.load_stats: Dict[str, Any] = {"backend": backend}
+        self._ids = itertools.count()
+        self._pending: Dict[int, asyncio.Future] = {}
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._reader_task: Optional[asyncio.Task] = None
+        self._connect_lock = asyncio.Lock()
+        self._process: Optional[subprocess.Popen] = None
+
+    @property
+    def is_loaded(self) -> bool:
+        return bool(self.load_stats.get("loaded"))
+
+    def start(self):
+        # a child that lost the race for the socket's lock exits right away, poll() also reaps it
+        if self.spawn and (self._process is None or self._process.poll() is not None):
+            self._process = subprocess.Popen(
+                [sys.executable, os.path.join(os.path.dirname(__file__), "inference_server.py"),
+                 "--socket", self.socket_path, "--backend", self.backend]
+            )
+
+    def stop(self, timeout: Optional[float] = None):
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        if self._process is not None:
+            # the server this worker started goes with it, the other workers spawn a new one when they reconnect
+            self._process.terminate()
+            try:
+                self._process.wait(timeout)
+            except subprocess.TimeoutExpired:
+                self._process.kill()
+                self._process.wait()
+            self._process = None
+
+    def qsize(self) -> int:
+        return len(self._pending)
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            **self.load_stats,
+            "requested_backend": self.backend,
+            "server": self.socket_path,
+            "connected": self._writer is not None,
+            "queue_depth": self.qsize()
+        }
+
+    async def refresh_status(self) -> Dict[str, Any]:
+        """
+        Ask the server how its model is doing and remember the answer for is_loaded and status().
+        """
+        response = await self._request({"op": "status"})
+        self.load_stats = response["status"]
+        return self.status()
+
+    async def generate(self, prompt: str, max_new_tokens: int = 25) -> str:
+        response = await self._request({"prompt": prompt, "max_new_tokens": max_new_tokens})
+        if "error" in response:
+            raise RuntimeError(f"inference server error: {response['error']}")
+        return response["text"]
+
+    async def _request(self, payload: dict) -> dict:
+        writer = await self._connect()
+        request_id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        try:
+            writer.write((json.dumps({"id": request_id, **payload}) + "\n").encode())
+            await writer.drain()
+            return await future
+        finally:
+            self._pending.pop(request_id, None)
+            answered = future.done() and not future.cancelled()
+            if not answered and writer is self._writer and not writer.is_closing():
+                # cancelled or timed out, the server need not spend a forward pass on it
+                writer.write((json.dumps({"id": request_id, "op": "cancel"}) + "\n").encode())
+
+    async def _connect(self) -> asyncio.StreamWriter:
+        async with self._connect_lock:
+            if self._writer is not None:
+                return self._writer
+
+            # a freshly spawned server may still be loading torch, keep retrying for a while
+            deadline = time.monotonic() + self.connect_timeout
+            while True:
+                try:
+                    reader, writer = await asyncio.open_unix_connection(self.socket_path, limit=STREAM_LIMIT)
+                    break
+                except (FileNotFoundError, ConnectionRefusedError):
+                    if time.monotonic() > deadline:
+                        raise
+                    self.start()
+                    await asyncio.sleep(0.5)
+
+            self._writer = writer
+            self._reader_task = asyncio.create_task(self._read_responses(reader))
+            return writer
+
+    async def _read_responses(self, reader: asyncio.StreamReader):
+        try:
+            while line := await reader.readline():
+                response = json.loads(line)
+                future = self._pending.get(response.get("id"))
+                if future is not None and not future.done():
+                    future.set_result(response)
+        finally:
+            self._writer = None
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("inference server connection closed"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+import asyncio
+from bisect import bisect_left, insort
+import logging
+from typing import Dict, List, Optional
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from database import MAX_SCORE, MIN_SCORE, UserModel, user_group_association
+
+
+log = logging.getLogger(__name__)
+
+class Leaderboard:
+    """
+    Users ranked by score (highest first, ties broken by username).
+
+    Scores are bounded integers, so users are kept in one sorted bucket per score and a Fenwick tree over the
+    bucket sizes answers "how many users rank above this score" in O(log(max_score - min_score)). Rank lookups add
+    a bisect within the bucket. Updates also insert into and delete from a bucket list, which is O(bucket size):
+    a memmove that stays in the tens of microseconds even with every user on the same score.
+    """
+
+    def __init__(self, min_score: int = MIN_SCORE, max_score: int = MAX_SCORE):
+        self.min_score = min_score
+        self.max_score = max_score
+        size = max_score - min_score + 1
+        self._tree = [0] * (size + 1)
+        self._buckets: List[List[str]] = [[] for _ in range(size)]
+        self._scores: Dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self._scores)
+
+    def __contains__(self, username: str) -> bool:
+        return username in self._scores
+
+    def update(self, username: str, score: int):
+        score = min(max(score, self.min_score), self.max_score)
+        if self._scores.get(username) == score:
+            return
+        self.remove(username)
+        self._scores[username] = score
+        index = self._index(score)
+        insort(self._buckets[index], username)
+        self._add(index, 1)
+
+    def remove(self, username: str):
+        if (score := self._scores.pop(username, None)) is None:
+            return
+        index = self._index(score)
+        bucket = self._buckets[index]
+        del bucket[bisect_left(bucket, username)]
+        self._add(index, -1)
+
+    def usernames(self) -> List[str]:
+        return list(self._scores)
+
+    def score(self, username: str) -> Optional[int]:
+        return self._scores.get(username)
+
+    def rank(self, username: str) -> Optional[int]:
+        """
+        1-based position of the user, or None if they are not ranked.
+        """
+        if (score := self._scores.get(username)) is None:
+            return None
+        index = self._index(score)
+        return self._prefix(index) + bisect_left(self._buckets[index], username) + 1
+
+    def top(self, limit: int) -> List[dict]:
+        return self.entries(1, limit)
+
+    def around(self, username: str, radius: int) -> List[dict]:
+        """
+        The user's entry together with up to `radius` entries on either side.
+        """
+        if (rank := self.rank(username)) is None:
+            return []
+        start = max(rank - radius, 1)
+        return self.entries(start, rank + radius - start + 1)
+
+    def entries(self, start_rank: int, count: int) -> List[dict]:
+        """
+        `count` consecutive entries beginning at `start_rank`.
+        """
+        if count <= 0 or start_rank > len(self._scores):
+            return []
+        index, offset = self._locate(start_rank)
+        entries = []
+        rank = start_rank
+        while index < len(self._buckets) and len(entries) < count:
+            bucket = self._buckets[index]
+            for username in bucket[offset:offset + count - len(entries)]:
+                entries.append({"rank": rank, "username": username, "score": self._score_at(index)})
+                rank += 1
+            index += 1
+            offset = 0
+        return entries
+
+    def _index(self, score: int) -> int:
+        # bucket 0 holds the best score so prefix sums count the users ranked above
+        return self.max_score - score
+
+    def _score_at(self, index: int) -> int:
+        return self.max_score - index
+
+    def _add(self, index: int, delta: int):
+        position = index + 1
+        while position < len(self._tree):
+            self._tree[position] += delta
+            position += position & -position
+
+    def _prefix(self, index: int) -> int:
+        """
+        Number of users in the buckets before `index`.
+        """
+        total = 0
+        position = index
+        while position > 0:
+            total += self._tree[position]
+            position -= position & -position
+        return total
+
+    def _locate(self, rank: int):
+        """
+        Bucket index and offset within it of the user at `rank`, found by descending the Fenwick tree.
+        """
+        position = 0
+        remaining = rank - 1
+        step = 1 << (len(self._tree) - 1).bit_length()
+        while step:
+            next_position = position + step
+            if next_position < len(self._tree) and self._tree[next_position] <= remaining:
+                position = next_position
+                remaining -= self._tree[next_position]
+            step >>= 1
+        return position, remaining
+
+
+class Leaderboards:
+    """
+    The global leaderboard plus one per group, kept in step by the endpoints that change scores or groups.
+    """
+
+    def __init__(self, min_score: int = MIN_SCORE, max_score: int = MAX_SCORE):
+        self.min_score = min_score
+        self.max_score = max_score
+        self.everyone = Leaderboard(min_score, max_score)
+        self.groups: Dict[str, Leaderboard] = {}
+        self._user_groups: Dict[str, str] = {}
+
+    def board(self, group_id: Optional[str] = None) -> Optional[Leaderboard]:
+        return self.everyone if group_id is None else self.groups.get(group_id)
+
+    def update(self, username: str, score: int):
+        self.everyone.update(username, score)
+        if (group_id := self._user_groups.get(username)) is not None:
+            self.groups[group_id].update(username, score)
+
+    def set_group(self, username: str, group_id: Optional[str]):
+        if (previous := self._user_groups.pop(username, None)) is not None:
+            board = self.groups[previous]
+            board.remove(username)
+            if not len(board):
+                del self.groups[previous]
+        if group_id is None or (score := self.everyone.score(username)) is None:
+            return
+        self._user_groups[username] = group_id
+        if group_id not in self.groups:
+            self.groups[group_id] = Leaderboard(self.min_score, self.max_score)
+        self.groups[group_id].update(username, score)
+
+    def remove_group(self, group_id: str):
+        if (board := self.groups.pop(group_id, None)) is None:
+            return
+        for username in board.usernames():
+            self._user_groups.pop(username, None)
+
+    async def load(self, session_factory: async_sessionmaker):
+        """
+        Rebuild every board from the users table.
+        """
+        query = (
+            select(UserModel.username, UserModel.score, user_group_association.c.group_id)
+            .outerjoin(user_group_association, user_group_association.c.user_id == UserModel.username)
+        )
+        everyone = Leaderboard(self.min_score, self.max_score)
+        groups: Dict[str, Leaderboard] = {}
+        user_groups: Dict[str, str] = {}
+        async with session_factory() as db:
+            result = await db.stream(query.execution_options(yield_per=1000))
+            async for username, score, group_id in result:
+                everyone.update(username, score)
+                if group_id is not None:
+                    user_groups[username] = group_id
+                    groups.setdefault(group_id, Leaderboard(self.min_score, self.max_score)).update(username, score)
+
+        self.everyone, self.groups, self._user_groups = everyone, groups, user_groups
+
+    async def run_refresher(self, session_factory: async_sessionmaker, interval: float):
+        """
+        Periodically rebuild from the database to pick up score changes made by other workers.
+        """
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.load(session_factory)
+            except Exception as e:
+                log.error(f"failed to refresh the leaderboard: {e}")
@@ -0,0 +1,181 @@
+import atexit
+import datetime as dt
+import json
+import logging
+from logging.handlers import QueueHandler, QueueListener
+import os
+import queue
+import random
+import sys
+from typing import Dict, Optional
+
+
+# level of everything not listed in LOG_LEVELS
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+
+# per subsystem levels by logger name, e.g. "scheduler=DEBUG,uvicorn.access=WARNING"
+LOG_LEVELS = os.getenv("LOG_LEVELS", "")
+
+# "json" writes one object per line for the log collector, "text" is easier to read locally
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+
+# share of DEBUG records kept, so debug logging can stay on under load
+LOG_DEBUG_SAMPLE = float(os.getenv("LOG_DEBUG_SAMPLE", "1"))
+
+# records waiting for the writer thread, further records are dropped rather than blocking the event loop
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+
+# "false", "true" for every SQL statement or "debug" to add result rows
+DB_ECHO = os.getenv("DB_ECHO", "false").lower()
+
+ECHO_LEVELS = {"false": logging.WARNING, "true": logging.INFO, "debug": logging.DEBUG}
+
+# servers that install their own handlers, their records are sent through the queue as well
+SERVER_LOGGERS = ("uvicorn", "uvicorn.error", "uvicorn.access")
+
+# LogRecord attributes, anything else on a record was passed through `extra` and is written as a field
+RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime", "taskName"}
+
+TEXT_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per record with the time, level, logger, message and any `extra` fields.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": dt.datetime.fromtimestamp(record.created, dt.timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage()
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES and not key.startswith("_"):
+                entry[key] = value
+        return json.dumps(entry, default=str)
+
+
+class DebugSampler(logging.Filter):
+    """
+    Keeps every record above DEBUG and a random `rate` share of DEBUG records.
+    """
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+        self.dropped = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.DEBUG or self.rate >= 1 or random.random() < self.rate:
+            return True
+        self.dropped += 1
+        return False
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    QueueHandler that counts and drops records once the queue is full instead of reporting an error per record.
+    """
+
+    def __init__(self, records: queue.Queue):
+        super().__init__(records)
+        self.dropped = 0
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # keep exc_info and extra fields for the formatter on the writer thread, only the message is merged here
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+_listener: Optional[QueueListener] = None
+_handler: Optional[DroppingQueueHandler] = None
+_sampler: Optional[DebugSampler] = None
+
+
+def parse_levels(levels: str) -> Dict[str, str]:
+    """
+    "name=LEVEL,other=LEVEL" as a dict, blank entries are ignored.
+    """
+    parsed = {}
+    for entry in levels.split(","):
+        if not entry.strip():
+            continue
+        name, _, level = entry.partition("=")
+        parsed[name.strip()] = level.strip().upper()
+    return parsed
+
+
+def configure_logging(
+    level: str = LOG_LEVEL,
+    levels: str = LOG_LEVELS,
+    json_output: bool = LOG_FORMAT == "json",
+    debug_sample: float = LOG_DEBUG_SAMPLE,
+    queue_size: int = LOG_QUEUE_SIZE,
+    db_echo: str = DB_ECHO
+):
+    """
+    Send every record through a bounded queue to a writer thread, so formatting and writing never happen on the
+    event loop. Safe to call again, the previous writer is flushed and replaced.
+    """
+    global _listener, _handler, _sampler
+    stop_logging()
+
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(JsonFormatter() if json_output else logging.Formatter(TEXT_FORMAT))
+
+    records: queue.Queue = queue.Queue(queue_size)
+    _sampler = DebugSampler(debug_sample)
+    _handler = DroppingQueueHandler(records)
+    _handler.addFilter(_sampler)
+    _listener = QueueListener(records, output, respect_handler_level=False)
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(_handler)
+    root.setLevel(level.upper())
+
+    for name in SERVER_LOGGERS:
+        server_logger = logging.getLogger(name)
+        for handler in list(server_logger.handlers):
+            server_logger.removeHandler(handler)
+        server_logger.propagate = True
+
+    # the engine is created without echo, which would attach its own synchronous stdout handler
+    logging.getLogger("sqlalchemy.engine").setLevel(ECHO_LEVELS.get(db_echo, logging.WARNING))
+    for name, subsystem_level in parse_levels(levels).items():
+        logging.getLogger(name).setLevel(subsystem_level)
+
+    _listener.start()
+
+
+def stop_logging():
+    """
+    Write out everything still queued and stop the writer thread.
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def logging_stats() -> Dict[str, int]:
+    return {
+        "queued": _handler.queue.qsize() if _handler is not None else 0,
+        "dropped": _handler.dropped if _handler is not None else 0,
+        "sampled_out": _sampler.dropped if _sampler is not None else 0
+    }
+
+
+atexit.register(stop_logging)
@@ -1,99 +1,180 @@
 import asyncio
-from dataclasses import dataclass
+from contextlib import asynccontextmanager, suppress
 import datetime as dt
 from dateutil import parser as datetime_parser
 import json
 import logging
 import math
 import os
-from typing import List, Optional
+from typing import Dict, List, Optional
 import uuid
 
-from dotenv import load_dotenv
-from fastapi import FastAPI, Form, HTTPException, WebSocket, WebSocketDisconnect
+from fastapi import BackgroundTasks, FastAPI, Form, HTTPException, Query, WebSocket, WebSocketDisconnect, WebSocketException, status
+from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+import numpy as np
 from pydantic import BaseModel
-from sqlalchemy import Boolean, Column, Date, DateTime, ForeignKey, Integer, String, Table, Time, create_engine
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship, joinedload
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import selectinload
+from sqlalchemy.orm.attributes import set_committed_value
 
-from transformers import pipeline
+from admission import GenerationBudget, RateLimiter
+from analytics import group_report, user_report
+from broadcast import BroadcastMessage, GroupWebSocket, create_bus
+from database import (
+    DB_SSL,
+    MAX_SCORE,
+    MIN_SCORE,
+    GroupModel,
+    SessionLocal,
+    SleepSessionModel,
+    SleepStatsModel,
+    SyncEventModel,
+    UserModel,
+    engine,
+    find_user,
+    init_db,
+    user_group_association,
+    warm_pool
+)
+from groups import GroupPlan, insert_groups, membership_errors
+from inference import InferenceWorker
+from inference_server import InferenceClient
+from leaderboard import Leaderboards
+from logs import configure_logging, logging_stats
+from message_cache import MessageCache
+from presence import PresenceTracker, strip_reserved
+from metrics import MetricsMiddleware, registry, stage
+from scheduler import DeadlineScheduler, RolloverResult
+from sessions import SessionRecorder, SleepSession
+from snapshots import SnapshotCache
+from startup import Startup
+from transitions import Advance, advance_group, apply_wake_up, fall_asleep, rejection, snooze, wake_up
 
 
-MAX_SCORE = 100
-MIN_SCORE = 0
+# respond to state changes with a templated message and push the generated one over the group websocket later
+DEFER_MESSAGES = os.getenv("DEFER_MESSAGES", "true").lower() in ("1", "true", "yes")
 
-logging.basicConfig(level=logging.DEBUG)
-log = logging.getLogger(__name__)
-generator = pipeline('text-generation', model='gpt2')
+# one of inference.MODEL_BACKENDS, loaded in the background once the app starts
+MODEL_BACKEND = os.getenv("MODEL_BACKEND", "gpt2")
+MODEL_PRELOAD = os.getenv("MODEL_PRELOAD", "true").lower() in ("1", "true", "yes")
 
+# share one model between all workers through inference_server.py listening on this socket
+INFERENCE_SOCKET = os.getenv("INFERENCE_SOCKET")
+INFERENCE_SPAWN = os.getenv("INFERENCE_SPAWN", "false").lower() in ("1", "true", "yes")
 
-##################
-# DATABASE SETUP #
-##################
+# "local" only reaches websockets held by this process, "postgres" fans out to every worker and replica
+BROADCAST_BACKEND = os.getenv("BROADCAST_BACKEND", "local")
 
-Base = declarative_base()
-load_dotenv()
+# every websocket gets its own outbound queue, full queues drop the connection unless WS_COALESCE is set
+WS_QUEUE_SIZE = int(os.getenv("WS_QUEUE_SIZE", "64"))
+WS_SEND_TIMEOUT = float(os.getenv("WS_SEND_TIMEOUT", "5"))
+WS_COALESCE = os.getenv("WS_COALESCE", "false").lower() in ("1", "true", "yes")
 
+# user and group snapshots served to the polling endpoints, per worker
+SNAPSHOT_CACHE_SIZE = int(os.getenv("SNAPSHOT_CACHE_SIZE", "10000"))
+SNAPSHOT_CACHE_TTL = float(os.getenv("SNAPSHOT_CACHE_TTL", "10"))
 
-user_group_association = Table(
-    'user_group_association', Base.metadata,
-    Column('user_id', String, ForeignKey('users.username'), primary_key=True),
-    Column('group_id', String, ForeignKey('groups.group_id'), primary_key=True)
-)
+# scores changed by other workers show up on this worker's leaderboard after the next rebuild
+LEADERBOARD_REFRESH_SECONDS = float(os.getenv("LEADERBOARD_REFRESH_SECONDS", "300"))
 
+# members still asleep this long after wake up time lose points when the night rolls over, members who never went
+# to sleep lose them as soon as the night ends
+OVERSLEEP_GRACE_MINUTES = int(os.getenv("OVERSLEEP_GRACE_MINUTES", "60"))
+OVERSLEEP_PENALTY = int(os.getenv("OVERSLEEP_PENALTY", "10"))
 
-class UserModel(Base):
-    __tablename__ = 'users'
-    username = Column(String, primary_key=True, nullable=False)
-    owns_a_group = Column(Boolean, nullable=False, default=False)
-
-    score = Column(Integer, nullable=False, default=MAX_SCORE)
-    average_minutes_slept = Column(Integer, nullable=True)
-    is_asleep = Column(Boolean, nullable=False, default=False)
-    last_sleep_time = Column(DateTime, nullable=True)
-    last_awake_time = Column(DateTime, nullable=True)
-    current_snooze_counter = Column(Integer, nullable=False, default=0)
-   
-    groups = relationship('GroupModel', secondary=user_group_association, back_populates='users')
-
-class GroupModel(Base):
-    __tablename__ = 'groups'
-    group_id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()), nullable=False)
-    owner_username = Column(String, ForeignKey('users.username'), nullable=True)
-    to_sleep_time = Column(DateTime, nullable=False)
-    to_wake_up_time = Column(DateTime, nullable=False)
-    duration_days = Column(Integer, nullable=False)
-    days_remaining = Column(Integer, nullable=False)
-    start_date = Column(Date, nullable=False)
-    
-    users = relationship('UserModel', secondary=user_group_association, back_populates='groups')
-    
+# groups created or moved on by other workers get nudges from this worker after the next reload
+SCHEDULER_RELOAD_SECONDS = float(os.getenv("SCHEDULER_RELOAD_SECONDS", "300"))
+
+# finished nights are buffered and written to the session history in batches
+SESSION_FLUSH_SECONDS = float(os.getenv("SESSION_FLUSH_SECONDS", "2"))
+SESSION_BATCH_SIZE = int(os.getenv("SESSION_BATCH_SIZE", "500"))
 
-user = os.getenv("user")
-password = os.getenv("password")
-host = os.getenv("host")
-dbname = os.getenv("dbname")
+# let clients ask for a per-request stage breakdown with the X-Snuz-Profile: 1 header
+PROFILE_REQUESTS = os.getenv("PROFILE_REQUESTS", "false").lower() in ("1", "true", "yes")
 
-DATABASE_URL = f"postgresql+psycopg2://{user}:{password}@{host}:5432/{dbname}?sslmode=require"
-engine = create_engine(DATABASE_URL, echo=True)
-Base.metadata.create_all(bind=engine)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# broadcasts each worker keeps per group for reconnecting websockets, and how many groups it keeps them for
+PRESENCE_REPLAY_SIZE = int(os.getenv("PRESENCE_REPLAY_SIZE", "256"))
+PRESENCE_MAX_GROUPS = int(os.getenv("PRESENCE_MAX_GROUPS", "10000"))
 
-# test the connection
-try:
-    with engine.connect() as connection:
-        log.debug("connection successful!")
-except Exception as e:
-    log.critical(f"failed to connect: {e}")
-    raise e
+# messages generated at once and how long each may take, anything beyond gets the templated message
+GENERATION_CONCURRENCY = int(os.getenv("GENERATION_CONCURRENCY", "8"))
+GENERATION_DEADLINE = float(os.getenv("GENERATION_DEADLINE", "2"))
+
+# /to-snooze requests per minute allowed for each user and each group, 0 turns the limit off
+SNOOZE_USER_PER_MINUTE = float(os.getenv("SNOOZE_USER_PER_MINUTE", "6"))
+SNOOZE_GROUP_PER_MINUTE = float(os.getenv("SNOOZE_GROUP_PER_MINUTE", "30"))
+
+MESSAGE_CACHE_SIZE = int(os.getenv("MESSAGE_CACHE_SIZE", "1024"))
+MESSAGE_CACHE_TTL = float(os.getenv("MESSAGE_CACHE_TTL", str(6 * 60 * 60)))
+MESSAGE_CACHE_BUCKET_MINUTES = int(os.getenv("MESSAGE_CACHE_BUCKET_MINUTES", "60"))
+MESSAGE_CACHE_WARM_INTERVAL = float(os.getenv("MESSAGE_CACHE_WARM_INTERVAL", "60"))
+
+log = logging.getLogger(__name__)
+if INFERENCE_SOCKET:
+    inference = InferenceClient(INFERENCE_SOCKET, MODEL_BACKEND, spawn=INFERENCE_SPAWN)
+else:
+    inference = InferenceWorker(MODEL_BACKEND, preload=MODEL_PRELOAD)
+snapshots = SnapshotCache(SessionLocal, maxsize=SNAPSHOT_CACHE_SIZE, ttl=SNAPSHOT_CACHE_TTL)
+leaderboards = Leaderboards(MIN_SCORE, MAX_SCORE)
+sessions = SessionRecorder(SessionLocal, flush_interval=SESSION_FLUSH_SECONDS, max_batch=SESSION_BATCH_SIZE)
+startup = Startup()
+generation = GenerationBudget(max_concurrent=GENERATION_CONCURRENCY, deadline=GENERATION_DEADLINE)
+user_snoozes = RateLimiter(SNOOZE_USER_PER_MINUTE)
+group_snoozes = RateLimiter(SNOOZE_GROUP_PER_MINUTE)
 
 
 #################
 # FASTAPI SETUP #
 #################
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # here rather than at import, so importing main does not take over the root logger and start a thread
+    configure_logging()
+    # the model loads on its own thread while the database is being set up
+    inference.start()
+    model = asyncio.create_task(startup.step("model", wait_for_model(), background=True)) if MODEL_PRELOAD else None
+
+    async def load_state():
+        await startup.step("schema", init_db())
+        await asyncio.gather(
+            startup.step("leaderboards", leaderboards.load(SessionLocal)),
+            startup.step("scheduler", scheduler.load())
+        )
+
+    await asyncio.gather(
+        startup.step("pool", warm_pool()),
+        load_state(),
+        startup.step("broadcast", bus.start())
+    )
+    warmer = asyncio.create_task(message_cache.run_warmer(utcnow, MESSAGE_CACHE_WARM_INTERVAL))
+    refresher = asyncio.create_task(leaderboards.run_refresher(SessionLocal, LEADERBOARD_REFRESH_SECONDS))
+    deadlines = asyncio.create_task(scheduler.run())
+    reloader = asyncio.create_task(scheduler.run_reloader(SCHEDULER_RELOAD_SECONDS))
+    recorder = asyncio.create_task(sessions.run())
+    startup.finish()
+    yield
+    startup.stopping = True
+    if model is not None:
+        model.cancel()
+    recorder.cancel()
+    # a flush cancelled halfway puts its batch back, stop() writes it
+    with suppress(asyncio.CancelledError):
+        await recorder
+    await sessions.stop()
+    reloader.cancel()
+    deadlines.cancel()
+    refresher.cancel()
+    warmer.cancel()
+    # a model still loading does not hold up shutdown, its thread is a daemon
+    inference.stop(timeout=5)
+    await bus.stop()
+
+
+app = FastAPI(lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=[
@@ -106,12 +187,97 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(
+    MetricsMiddleware,
+    request_seconds=registry.histogram(
+        "snuz_request_seconds",
+        "HTTP request latency by endpoint",
+        ("method", "route", "status")
+    ),
+    profiling=PROFILE_REQUESTS
+)
+registry.gauge(
+    "snuz_websocket_connections",
+    "Websockets connected to this worker per group",
+    lambda: {(group_id,): len(socket.connections) for group_id, socket in group_websockets.items()},
+    ("group_id",)
+)
+registry.gauge("snuz_group_websockets", "Groups with websocket state on this worker", lambda: len(group_websockets))
+registry.gauge("snuz_db_pool_checked_out", "Database connections currently checked out", lambda: engine.pool.checkedout())
+registry.gauge("snuz_inference_queue_depth", "Prompts waiting for the model", lambda: inference.qsize())
+registry.gauge("snuz_sleep_sessions_pending", "Finished nights waiting to be written", lambda: sessions.stats()["pending"])
+registry.counter(
+    "snuz_log_records_dropped_total",
+    "Log records dropped because the log queue was full, or sampled out at DEBUG",
+    lambda: {("queue_full",): logging_stats()["dropped"], ("sampled",): logging_stats()["sampled_out"]},
+    ("reason",)
+)
+registry.gauge("snuz_presence_groups", "Groups whose presence this worker tracks", lambda: presences.stats()["groups"])
+registry.counter(
+    "snuz_websocket_catch_ups_total",
+    "Websocket connects answered with a replay of missed broadcasts or a presence snapshot",
+    lambda: {("replay",): presences.stats()["replays"], ("snapshot",): presences.stats()["snapshots"]},
+    ("kind",)
+)
+registry.counter(
+    "snuz_generation_requests_total",
+    "State change messages by how generation went, degraded ones were answered with the template",
+    lambda: {(outcome,): generation.stats()[outcome] for outcome in ("admitted", "shed", "timed_out", "failed", "degraded")},
+    ("outcome",)
+)
+registry.gauge("snuz_generation_in_flight", "Messages being generated right now", lambda: generation.in_flight)
+registry.counter(
+    "snuz_snooze_rate_limited_total",
+    "/to-snooze requests refused by the per user and per group limits",
+    lambda: {("user",): user_snoozes.limited, ("group",): group_snoozes.limited},
+    ("scope",)
+)
+registry.gauge("snuz_ready", "1 once this worker is ready for traffic", lambda: int(startup.ready))
+registry.gauge(
+    "snuz_startup_step_seconds",
+    "Time each startup step took",
+    lambda: {(name,): seconds for name, seconds in startup.timings.items()},
+    ("step",)
+)
 
 
 @app.get("/")
 async def get_root():
     return {"message": "hello from server"}
 
+@app.get("/healthz")
+async def healthz():
+    """
+    Liveness, the event loop is answering.
+    """
+    return {"status": "ok"}
+
+@app.get("/readyz")
+async def readyz():
+    """
+    Readiness, 503 until startup has finished and the model is loaded, and again once shutdown begins.
+    """
+    return JSONResponse(startup.report(), status_code=200 if startup.ready else 503)
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/cache-stats")
+async def cache_stats():
+    return {
+        **snapshots.stats(),
+        "messages": message_cache.cache.stats()
+    }
+
+@app.get("/model-status")
+async def model_status():
+    if isinstance(inference, InferenceClient):
+        status = await inference.refresh_status()
+    else:
+        status = inference.status()
+    return {**status, "generation": generation.stats()}
+
 ##################
 # AUTH ENDPOINTS #
 ##################
@@ -125,55 +291,100 @@ async def create_user(username: str = Form(...)):
     
     db = SessionLocal()
     
-    if find_user(db, username) is not None:
-        raise HTTPException(status_code=404, detail=f"User already exists: {username}")
-        
     try:
+        if await find_user(db, username) is not None:
+            raise HTTPException(status_code=404, detail=f"User already exists: {username}")
+
         new_user = UserModel(username=username)
         db.add(new_user)
-        db.commit()
-        db.refresh(new_user)
+        with stage("commit"):
+            await db.commit()
+        await db.refresh(new_user)
+    except HTTPException:
+        raise
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=500, detail=f"Failed to create user: {username}")
     finally:
-        db.close()
+        await db.close()
     
     # check for the user
-    with SessionLocal() as db:
-        if find_user(db, username) is None:
+    async with SessionLocal() as db:
+        if await find_user(db, username) is None:
             raise HTTPException(status_code=500, detail=f"Failed to create user: {username}")
         
+    leaderboards.update(username, MAX_SCORE)
     return {"message": f"User created: {username}"}
 
 @app.post("/login")
 async def login(username: str = Form(...)):
-    with SessionLocal() as db:
-        user = find_user(db, username)
-        if user is None:
-            raise HTTPException(status_code=500, detail=f"User does not exist: {username}")
+    user = await snapshots.get_user(username)
+    if user is None:
+        raise HTTPException(status_code=500, detail=f"User does not exist: {username}")
     return {
         "message": "user found",
         "username": user.username
     }
 
+USER_DATA_FIELDS = {
+    "owns_a_group": UserModel.owns_a_group,
+    "group_id": user_group_association.c.group_id,
+    "score": UserModel.score,
+    "average_minutes_slept": UserModel.average_minutes_slept,
+    "is_asleep": UserModel.is_asleep,
+    "last_sleep_time": UserModel.last_sleep_time,
+    "last_awake_time": UserModel.last_awake_time
+}
+USER_DATA_CHUNK_ROWS = 200
+
+
 @app.get("/all-user-data")
-async def all_user_data():
-    with SessionLocal() as db:
-        users = db.query(UserModel).all()                
-        return {"users": [
-            {
-                "message": "user found",
-                "username": user.username,
-                "owns_a_group": user.owns_a_group,
-                "group_id": None if not user.groups else user.groups[0].group_id,
-                "score": user.score,
-                "average_minutes_slept": user.average_minutes_slept,
-                "is_asleep": user.is_asleep,
-                "last_sleep_time": user.last_sleep_time,
-                "last_awake_time": user.last_awake_time
-            } for user in users]
-        }
+async def all_user_data(
+    limit: Optional[int] = Query(None, ge=1, le=1000),
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None
+):
+    """
+    Stream every user, ordered by username.
+
+    Pass `limit` to page through the users, `cursor` is the `next_cursor` of the previous page. `fields` is a comma
+    separated subset of the user fields to include, username is always returned.
+    """
+    selected = list(USER_DATA_FIELDS) if fields is None else [field for field in fields.split(",") if field]
+    if unknown := set(selected) - set(USER_DATA_FIELDS):
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(sorted(unknown))}")
+
+    # users belong to at most one group, so the association join keeps one row per user
+    query = (
+        select(UserModel.username, *(USER_DATA_FIELDS[field] for field in selected))
+        .outerjoin(user_group_association, user_group_association.c.user_id == UserModel.username)
+        .order_by(UserModel.username)
+    )
+    if cursor is not None:
+        query = query.filter(UserModel.username > cursor)
+    if limit is not None:
+        query = query.limit(limit)
+
+    async def stream_users():
+        yield '{"users": ['
+        count = 0
+        last_username = None
+        async with SessionLocal() as db:
+            result = await db.stream(query.execution_options(yield_per=USER_DATA_CHUNK_ROWS))
+            async for rows in result.partitions():
+                chunk = []
+                for row in rows:
+                    user = {"message": "user found", "username": row.username}
+                    user.update((field, row._mapping[USER_DATA_FIELDS[field]]) for field in selected)
+                    chunk.append(json.dumps(user, default=jsonable_encoder))
+                    last_username = row.username
+                yield ("," if count else "") + ",".join(chunk)
+                count += len(chunk)
+
+        next_cursor = last_username if limit is not None and count == limit else None
+        yield f'], "next_cursor": {json.dumps(next_cursor)}}}'
+
+    return StreamingResponse(stream_users(), media_type="application/json")
 
 
 #################
@@ -182,15 +393,14 @@ async def all_user_data():
 
 @app.post("/get-user-data")
 async def user(username: str = Form(...)):
-    with SessionLocal() as db:
-        if (user := find_user(db, username)) is None:
-            raise HTTPException(status_code=500, detail=f"User does not exist: {username}")
+    if (user := await snapshots.get_user(username)) is None:
+        raise HTTPException(status_code=500, detail=f"User does not exist: {username}")
             
     return {
         "message": "user found",
         "username": user.username,
         "owns_a_group": user.owns_a_group,
-        "group_id": None if not user.groups else user.groups[0].group_id,
+        "group_id": user.group_id,
         "score": user.score,
         "average_minutes_slept": user.average_minutes_slept,
         "is_asleep": user.is_asleep,
@@ -200,173 +410,418 @@ async def user(username: str = Form(...)):
     
     
 @app.post("/to-sleep")
-async def to_sleep(username: str = Form(...)):
-    with SessionLocal() as db:
-        if (user := find_user(db, username)) is None:
-            raise HTTPException(status_code=500, detail=f"User does not exist: {username}")
-        if not user.groups:
-            raise HTTPException(status_code=500, detail=f"{username} is not in a group")
-        
-        if user.is_asleep:
-            raise HTTPException(status_code=500, detail=f"{username} is already asleep!")
-        # TODO: prevent from sleepig to early
-        user.is_asleep = True
-        user.last_sleep_time = dt.datetime.now(dt.timezone.utc)
-        user.last_awake_time = None
-        user.current_snooze_counter = 0
-        
+async def to_sleep(background_tasks: BackgroundTasks, username: str = Form(...)):
+    # TODO: prevent from sleepig to early
+    async with SessionLocal() as db:
         try:
-            db.commit()
+            with stage("transition"):
+                transition = await fall_asleep(db, username, utcnow())
+            if transition is None:
+                raise HTTPException(status_code=500, detail=await rejection(db, username))
+            with stage("commit"):
+                await db.commit()
+        except HTTPException:
+            raise
         except Exception as e:
-            db.rollback()
+            await db.rollback()
             raise HTTPException(status_code=500, detail=f"Failed to mark user as sleeping: {username}")
-    
-        prompt = f"{user.username} went to sleep at {user.last_sleep_time}",
-        result = result = generator(prompt, max_new_tokens=25, num_return_sequences=1)
-        message = result[0]["generated_text"]
-       
-        await group_websockets[user.groups[0].group_id].broadcast(BroadcastMessage(
-            "to-sleep",
-            user.username,
-            {
-                "message": message,
-                "asleep": [u.username for u in user.groups[0].users if u.is_asleep]
-            }
-        ))
-    
-        return {"message": message}
-    return {"message": f"User marked as sleeping: {username}"}
+    snapshots.invalidate_user(username)
+
+    return await announce_state_change(
+        background_tasks,
+        transition.group_id,
+        "to-sleep",
+        username,
+        transition.last_sleep_time,
+        presence={"asleep": [username]}
+    )
 
 @app.post("/to-awake")
-async def to_awake(username: str = Form(...)):
-    with SessionLocal() as db:
-        if (user := find_user(db, username)) is None:
-            raise HTTPException(status_code=500, detail=f"User does not exist: {username}")
-        if not (groups := user.groups):
-            raise HTTPException(status_code=500, detail=f"{username} is not in a group")
-        if not user.is_asleep:
-            raise HTTPException(status_code=500, detail=f"{username} is not alseep yet!")
-        
+async def to_awake(background_tasks: BackgroundTasks, username: str = Form(...)):
+    async with SessionLocal() as db:
         try:
-            user.is_asleep = False    
-            user.last_awake_time = dt.datetime.now(dt.timezone.utc)
-        
-            to_sleep_goal = user.groups[0].to_sleep_time.replace(tzinfo=dt.timezone.utc)
-            to_awake_goal = user.groups[0].to_wake_up_time.replace(tzinfo=dt.timezone.utc)
-            
-            last_sleep_time = user.last_sleep_time.replace(tzinfo=dt.timezone.utc)
-            today_minutes_slept = int((user.last_awake_time - last_sleep_time).total_seconds() // 60)
-            
-            if user.average_minutes_slept is None:
-                user.average_minutes_slept = today_minutes_slept
-            else:
-                user.average_minutes_slept = (user.average_minutes_slept + today_minutes_slept) // 2 
-            
-            minutes_slept_diff = today_minutes_slept - user.average_minutes_slept # if positive, slept more than avg. if negative, slept less than avg. 
-            to_sleep_diff = int((to_sleep_goal - last_sleep_time).total_seconds() // (60 * 5))
-            to_awake_diff = int((user.last_awake_time - to_awake_goal).total_seconds() // (60 * 5))
-            diff_summary = minutes_slept_diff + to_sleep_diff + to_awake_diff
-            
-            user.score = min(max(math.floor(user.score + (diff_summary * 0.2) - user.current_snooze_counter), MIN_SCORE), MAX_SCORE)    
-            user.current_snooze_counter = 0
-        
-            db.commit()
+            with stage("transition"):
+                transition = await wake_up(db, username, utcnow(), missed_sleep_penalty=OVERSLEEP_PENALTY)
+            if transition is None:
+                raise HTTPException(status_code=500, detail=await rejection(db, username))
+            with stage("commit"):
+                await db.commit()
+        except HTTPException:
+            raise
         except Exception as e:
-            db.rollback()
+            await db.rollback()
             raise HTTPException(status_code=500, detail=f"Failed to mark user as awake: {username}: {e}")
-    
 
-        # check if anyone else is awake
-        # TODO: what if someone didnt actually sleep?
-        everyone_is_awake = True
-        group = groups[0]
-        for group_member in group.users:
-            if group_member.is_asleep:
-                everyone_is_awake = False
-                break
-        
-        group_id = group.group_id
-        if everyone_is_awake: # update the group data
-            try:
-                group.days_remaining -= 1
-                if group.days_remaining != 0: # update the next sleep time
-                    #! Feature not bug. If someone does not sleep, by the time everyone else wakes up, then to bad.
-                
-                    date_diff = group.duration_days - group.days_remaining
-                    new_start_date = group.start_date + dt.timedelta(days=date_diff)
-                    new_wake_up_time = group.to_wake_up_time.time()
-                    new_sleep_time = group.to_sleep_time.time()
-                    
-                    group.to_sleep_time = dt.datetime.combine(new_start_date, new_sleep_time)
-                    if new_wake_up_time >= new_sleep_time: # sleep and wake up on the same day
-                        group.to_wake_up_time = dt.datetime.combine(new_start_date, new_wake_up_time)
-                    else:
-                        group.to_wake_up_time = dt.datetime.combine(new_start_date + dt.timedelta(days=1), new_wake_up_time)       
-                else: # end of sleep challenge                                
-                    for user in group.users:
-                        group.users.remove(user)
-                    db.delete(group)
-                    
-                db.commit()    
-            except Exception as e:
-                db.rollback()
-                raise HTTPException(status_code=500, detail=f"Failed to update group data: {username}: {e}")         
-        # else:
-            # TODO: oversleeping penelty
-       
-        prompt = f"{user.username} woke up at {user.last_awake_time}",
-        result = result = generator(prompt, max_new_tokens=25, num_return_sequences=1)
-        message = result[0]["generated_text"]
-       
-        
-        await group_websockets[user.groups[0].group_id].broadcast(BroadcastMessage(
-            "to-awake",
-            user.username,
-            {
-                "message": message,
-                "awake": [u.username for u in user.groups[0].users if not u.is_asleep]
-            }
-        ))
-        
-        group_socket = group_websockets.get(group_id)
-        if group_socket:
-                del group_websockets[group_websockets]
-    
-        return {"message": message}
-    return {"message": f"User marked as awake: {username}"}
+    group_id = transition.group_id
+    snapshots.invalidate_user(username)
+    leaderboards.update(username, transition.score)
+    sessions.record(SleepSession(
+        username=username,
+        group_id=group_id,
+        slept_at=transition.last_sleep_time,
+        woke_at=transition.last_awake_time,
+        snoozes=transition.snoozes,
+        sleep_goal=transition.sleep_goal,
+        wake_goal=transition.wake_goal
+    ))
+    for penalized, score in transition.penalized.items():
+        leaderboards.update(penalized, score)
+    if transition.group_advanced:
+        snapshots.invalidate_group(group_id, [member.username for member in transition.members])
+        if transition.group_finished:
+            scheduler.unschedule(group_id)
+        else:
+            scheduler.schedule(group_id, transition.next_sleep_time, transition.next_wake_up_time)
+    # oversleeping is penalized by the scheduler once the group's grace period is over
+
+    response = await announce_state_change(
+        background_tasks,
+        group_id,
+        "to-awake",
+        username,
+        transition.last_awake_time,
+        presence={"awake": [username], "finished": transition.group_finished}
+    )
+
+    if transition.group_finished:
+        group_websockets.pop(group_id, None)
+        leaderboards.remove_group(group_id)
+
+    return response
 
 @app.post("/to-snooze")
-async def to_snooze(username: str = Form(...)):
-    with SessionLocal() as db:
-        if (user := find_user(db, username)) is None:
-            raise HTTPException(status_code=500, detail=f"User does not exist: {username}")        
-        if not user.is_asleep:
-            raise HTTPException(status_code=500, detail=f"{username} is not asleep yet!")
-        
-        user.current_snooze_counter += 1
-        
+async def to_snooze(background_tasks: BackgroundTasks, username: str = Form(...)):
+    if retry_after := user_snoozes.hit(username):
+        raise HTTPException(
+            status_code=429,
+            detail=f"{username} is snoozing too often, try again in {math.ceil(retry_after)}s",
+            headers={"Retry-After": str(math.ceil(retry_after))}
+        )
+    if (user := await snapshots.get_user(username)) is not None and user.group_id is not None:
+        if retry_after := group_snoozes.hit(user.group_id):
+            raise HTTPException(
+                status_code=429,
+                detail=f"{username}'s group is snoozing too often, try again in {math.ceil(retry_after)}s",
+                headers={"Retry-After": str(math.ceil(retry_after))}
+            )
+
+    async with SessionLocal() as db:
         try:
-            db.commit()
+            with stage("transition"):
+                transition = await snooze(db, username)
+            if transition is None:
+                raise HTTPException(status_code=500, detail=await rejection(db, username))
+            with stage("commit"):
+                await db.commit()
+        except HTTPException:
+            raise
         except Exception as e:
-            db.rollback()
+            await db.rollback()
             raise HTTPException(status_code=500, detail=f"Failed increment snooze counter: {username}")
-        
-        prompt = (
-            f"{user.username} let down their team by hitting snooze at {dt.datetime.now(dt.timezone.utc).replace(tzinfo=None)}"
+    snapshots.invalidate_user(username)
+
+    return await announce_state_change(
+        background_tasks,
+        transition.group_id,
+        "to-snooze",
+        username,
+        utcnow()
+    )
+
+
+SYNC_OPERATIONS = ("to-sleep", "to-snooze", "to-awake")
+SYNC_MAX_EVENTS = 1000
+# client clocks may run a little ahead of ours
+SYNC_CLOCK_SKEW = dt.timedelta(minutes=5)
+
+
+class SyncEvent(BaseModel):
+    idempotency_key: str
+    username: str
+    operation: str
+    timestamp: str
+
+
+class SyncEventsData(BaseModel):
+    events: List[SyncEvent]
+
+
+@app.post("/sync-events")
+async def sync_events(sync_events_data: SyncEventsData):
+    """
+    Apply an ordered batch of state changes recorded offline, for one or many users, in one transaction.
+
+    Events run through the same state machine as /to-sleep, /to-snooze and /to-awake using the client's
+    timestamps. Each event is reported as applied, duplicate (its idempotency key was already applied for that
+    user) or rejected, and each group gets one summary broadcast instead of a message per event, sent in numbered
+    parts when it is too long for the broadcast bus.
+    """
+    events = sync_events_data.events
+    if len(events) > SYNC_MAX_EVENTS:
+        raise HTTPException(status_code=400, detail=f"At most {SYNC_MAX_EVENTS} events can be synced at once")
+
+    now = utcnow()
+    usernames = {event.username for event in events}
+    results = []
+    applied = []
+    touched_users = set()
+    touched_groups: Dict[str, GroupModel] = {}
+    group_members: Dict[str, List[str]] = {}
+    finished_groups = set()
+    penalized: Dict[str, int] = {}
+    nights: List[SleepSession] = []
+
+    async with SessionLocal() as db:
+        # lock the groups before their members, in the same order as transitions.wake_up, so the events cannot
+        # interleave with live requests or another sync for these users before the commit
+        await db.execute(
+            select(GroupModel.group_id)
+            .join(user_group_association, user_group_association.c.group_id == GroupModel.group_id)
+            .filter(user_group_association.c.user_id.in_(usernames))
+            .order_by(GroupModel.group_id)
+            .with_for_update(of=GroupModel)
         )
-        result = result = generator(prompt, max_new_tokens=25, num_return_sequences=1)
-        message = result[0]["generated_text"]
-    
-        await group_websockets[user.groups[0].group_id].broadcast(BroadcastMessage(
-            "to-snooze",
-            user.username,
+        await db.execute(
+            select(UserModel.username)
+            .filter(UserModel.username.in_(usernames))
+            .order_by(UserModel.username)
+            .with_for_update()
+        )
+        result = await db.execute(
+            select(UserModel)
+            .options(selectinload(UserModel.groups).selectinload(GroupModel.users))
+            .filter(UserModel.username.in_(usernames))
+        )
+        users = {user.username: user for user in result.scalars()}
+        result = await db.execute(
+            select(SyncEventModel.username, SyncEventModel.idempotency_key)
+            .filter(
+                SyncEventModel.username.in_(usernames),
+                SyncEventModel.idempotency_key.in_({event.idempotency_key for event in events})
+            )
+        )
+        seen = set(result.all())
+        # state changes must not go back in time for a user
+        latest = {
+            username: max((t for t in (user.last_sleep_time, user.last_awake_time) if t is not None), default=None)
+            for username, user in users.items()
+        }
+
+        for event in events:
+            key = (event.username, event.idempotency_key)
+            if key in seen:
+                results.append({"idempotency_key": event.idempotency_key, "status": "duplicate"})
+                continue
+            try:
+                timestamp = parse_client_time(event.timestamp)
+                user = users.get(event.username)
+                if event.operation not in SYNC_OPERATIONS:
+                    raise ValueError(f"Unknown operation: {event.operation}")
+                if user is None:
+                    raise ValueError(f"User does not exist: {event.username}")
+                if timestamp > now + SYNC_CLOCK_SKEW:
+                    raise ValueError(f"Event is in the future: {event.timestamp}")
+                if latest[user.username] is not None and timestamp < latest[user.username]:
+                    raise ValueError(f"Event is older than {user.username}'s last state change")
+                if not user.groups:
+                    raise ValueError(f"{user.username} is not in a group")
+                if event.operation == "to-sleep" and user.is_asleep:
+                    raise ValueError(f"{user.username} is already asleep!")
+                if event.operation != "to-sleep" and not user.is_asleep:
+                    raise ValueError(f"{user.username} is not asleep yet!")
+            except ValueError as e:
+                results.append({"idempotency_key": event.idempotency_key, "status": "rejected", "detail": str(e)})
+                continue
+
+            group = user.groups[0]
+            if event.operation == "to-sleep":
+                user.is_asleep = True
+                user.last_sleep_time = timestamp
+                user.last_awake_time = None
+                user.current_snooze_counter = 0
+            elif event.operation == "to-snooze":
+                user.current_snooze_counter += 1
+            else:
+                snoozes = user.current_snooze_counter
+                apply_wake_up(user, group, timestamp)
+                nights.append(night_of(user, group, snoozes))
+            latest[user.username] = max(latest[user.username] or timestamp, timestamp)
+
+            seen.add(key)
+            touched_users.add(user.username)
+            touched_groups[group.group_id] = group
+            group_members[group.group_id] = [u.username for u in group.users]
+            applied.append((group.group_id, event, timestamp))
+            db.add(SyncEventModel(
+                username=user.username,
+                idempotency_key=event.idempotency_key,
+                operation=event.operation,
+                occurred_at=timestamp,
+                received_at=now
+            ))
+            results.append({"idempotency_key": event.idempotency_key, "status": "applied"})
+
+            # the last member to wake up moves the group on through the same guarded update and missed sleep penalty
+            # as /to-awake, later events in the batch see the next night
+            if event.operation == "to-awake" and not any(u.is_asleep for u in group.users):
+                try:
+                    await db.flush()
+                except IntegrityError:
+                    await db.rollback()
+                    raise HTTPException(
+                        status_code=409,
+                        detail="Some of these events are being synced by another request"
+                    )
+                advance = await advance_group(db, group, [u.username for u in group.users], OVERSLEEP_PENALTY)
+                if advance is not None:
+                    track_advance(group, advance)
+                    penalized.update(advance.penalized)
+                    if advance.finished:
+                        finished_groups.add(group.group_id)
+
+        try:
+            with stage("commit"):
+                await db.commit()
+        except IntegrityError:
+            await db.rollback()
+            raise HTTPException(status_code=409, detail="Some of these events are being synced by another request")
+        except Exception as e:
+            await db.rollback()
+            raise HTTPException(status_code=500, detail=f"Failed to sync events: {e}")
+
+    for night in nights:
+        sessions.record(night)
+    snapshots.invalidate_user(*touched_users, *penalized)
+    for username, score in penalized.items():
+        leaderboards.update(username, score)
+    for username in touched_users:
+        leaderboards.update(username, users[username].score)
+
+    # one summary per group rather than a generated message per event
+    for group_id, group in touched_groups.items():
+        finished = group_id in finished_groups
+        touched = [username for username in group_members[group_id] if username in touched_users]
+        snapshots.invalidate_group(group_id, group_members[group_id])
+        if finished:
+            scheduler.unschedule(group_id)
+            leaderboards.remove_group(group_id)
+        else:
+            scheduler.schedule(group_id, group.to_sleep_time, group.to_wake_up_time)
+
+        summary = BroadcastMessage(
+            "sync",
+            "snuz",
             {
-                "message": message,
-                "asleep": [u.username for u in user.groups[0].users if u.is_asleep],
-                "awake": [u.username for u in user.groups[0].users if not u.is_asleep]
+                "events": [
+                    {"username": event.username, "operation": event.operation, "timestamp": timestamp.isoformat()}
+                    for event_group_id, event, timestamp in applied if event_group_id == group_id
+                ],
+                "finished": finished
+            },
+            presence={
+                "asleep": [username for username in touched if users[username].is_asleep],
+                "awake": [username for username in touched if not users[username].is_asleep],
+                "finished": finished
             }
-        ))
-    return {"message": message}
+        )
+        # a long batch is sent in parts small enough for the broadcast bus to forward to every node
+        for message in summary.split("events", lambda payload: bus.fits(group_id, payload)):
+            await broadcast_to_group(group_id, message)
+        if finished:
+            group_websockets.pop(group_id, None)
+
+    return {
+        "applied": sum(1 for result in results if result["status"] == "applied"),
+        "duplicates": sum(1 for result in results if result["status"] == "duplicate"),
+        "rejected": sum(1 for result in results if result["status"] == "rejected"),
+        "results": results
+    }
+
+
+@app.get("/sleep-analytics")
+async def sleep_analytics(
+    username: str,
+    nights: int = Query(30, ge=1, le=365),
+    window: int = Query(7, ge=1, le=90)
+):
+    """
+    Rolling averages, consistency and snooze trends over the user's last `nights` nights, their all-time figures,
+    and how they compare with the rest of their group. Nights show up here once the session recorder has flushed.
+    """
+    if (user := await snapshots.get_user(username)) is None:
+        raise HTTPException(status_code=500, detail=f"User does not exist: {username}")
+    members = (username,)
+    if user.group_id is not None and (group := await snapshots.get_group(user.group_id)) is not None:
+        members = group.members
+
+    async with SessionLocal() as db:
+        result = await db.execute(
+            select(
+                SleepSessionModel.slept_at,
+                SleepSessionModel.woke_at,
+                SleepSessionModel.minutes_slept,
+                SleepSessionModel.snoozes
+            )
+            .filter(SleepSessionModel.username == username)
+            .order_by(SleepSessionModel.woke_at.desc())
+            .limit(nights)
+        )
+        rows = result.all()[::-1]
+        result = await db.execute(
+            select(
+                SleepStatsModel.username,
+                SleepStatsModel.nights,
+                SleepStatsModel.total_minutes,
+                SleepStatsModel.total_minutes_squared,
+                SleepStatsModel.total_snoozes,
+                SleepStatsModel.nights_snoozed
+            )
+            .filter(SleepStatsModel.username.in_(set(members) | {username}))
+        )
+        totals = {row[0]: row[1:] for row in result.all()}
+
+    slept_at, woke_at, minutes_slept, snoozes = zip(*rows) if rows else ((), (), (), ())
+    group_totals = np.array([totals.get(member, (0, 0, 0, 0, 0)) for member in members], dtype=np.int64)
+    comparison = group_report(members, group_totals.reshape(-1, 5))
+    return {
+        "username": username,
+        "recent": user_report(
+            np.array(slept_at, dtype="datetime64[us]"),
+            np.array(woke_at, dtype="datetime64[us]"),
+            np.array(minutes_slept, dtype=np.int64),
+            np.array(snoozes, dtype=np.int64),
+            window
+        ),
+        "all_time": next(member for member in comparison["members"] if member["username"] == username),
+        "group": comparison if user.group_id is not None else None
+    }
+
+
+###############
+# LEADERBOARD #
+###############
+
+@app.get("/leaderboard")
+async def leaderboard(
+    limit: int = Query(10, ge=0, le=100),
+    group_id: Optional[str] = None,
+    username: Optional[str] = None,
+    radius: int = Query(2, ge=0, le=50)
+):
+    """
+    Top `limit` users, across everyone or within `group_id`. With `username` the response also has that user's
+    rank and the `radius` users ranked directly above and below them.
+    """
+    if (board := leaderboards.board(group_id)) is None:
+        raise HTTPException(status_code=404, detail=f"Group does not exist: {group_id}")
+
+    response = {"total": len(board), "top": board.top(limit)}
+    if username is not None:
+        if (rank := board.rank(username)) is None:
+            raise HTTPException(status_code=404, detail=f"User is not ranked: {username}")
+        response["user"] = {"username": username, "rank": rank, "score": board.score(username)}
+        response["around"] = board.around(username, radius)
+    return response
 
 
 # #############################
@@ -382,180 +837,413 @@ class CreateGroupData(BaseModel):
     start_date: str
     
 
+# groups created by one /create-groups call, all members are checked with one query
+CREATE_GROUPS_MAX = 500
+
+
+class CreateGroupsData(BaseModel):
+    groups: List[CreateGroupData]
+
+
 @app.post("/create-group")
 async def create_group(create_group_data: CreateGroupData):
-    with SessionLocal() as db:
-        if find_user(db, create_group_data.owner_username) is None:
-            raise HTTPException(status_code=500, detail=f"Owner does not exist: {create_group_data.owner_username}")
-        
-        group_members = []
-        for member in create_group_data.group_members:
-            if (user := find_user(db, member)) is None:
-                raise HTTPException(status_code=500, detail=f"Member does not exist: {member}")
-            else:
-                if not user.groups:
-                    group_members.append(user)
-                else:
-                    raise HTTPException(status_code=400, detail=f"{member} is already a member of another group")
-        if create_group_data.duration_days < 1:
-            raise HTTPException(status_code=400, detail="Duration must be at least 1 day")
-        if datetime_parser.isoparse(create_group_data.start_date) < dt.datetime.now(dt.timezone.utc):
-            raise HTTPException(status_code=400, detail="Start date must be in the future")
-
-        if create_group_data.owner_username not in create_group_data.group_members:
-            create_group_data.group_members.append(create_group_data.owner_username)
-        
-        try:        
-            if dt.datetime.now(dt.timezone.utc) > datetime_parser.isoparse(create_group_data.to_sleep_time):                
-                raise HTTPException(status_code=400, detail="Cannot schedule a sleeping time in the past")
-            
-            sleep_time = datetime_parser.isoparse(create_group_data.to_sleep_time).time()
-            wake_up_time = datetime_parser.isoparse(create_group_data.to_wake_up_time).time()
-            start_date = datetime_parser.isoparse(create_group_data.to_wake_up_time).date()
-             
-        except Exception as e:
-            raise HTTPException(status_code=400, detail=f"Invalid ISO 8601 format for sleep, wake or start: {e}")
-        try:
-            if wake_up_time >= sleep_time: # sleep and wake up on the same day
-                sleep_time = dt.datetime.combine(start_date, sleep_time)
-                wake_up_time = dt.datetime.combine(start_date, wake_up_time)
-            else:
-                sleep_time = dt.datetime.combine(start_date, sleep_time)
-                wake_up_time = dt.datetime.combine(start_date + dt.timedelta(days=1), wake_up_time)
-                
-        except Exception as e:
-            raise HTTPException(status_code=400, detail=f"Error in combining date and time: {e}")
-        
-        try:
-            new_group = GroupModel(
-                owner_username=create_group_data.owner_username,
-                to_sleep_time=sleep_time,
-                to_wake_up_time=wake_up_time,
-                duration_days=create_group_data.duration_days,
-                days_remaining=create_group_data.duration_days,
-                start_date=start_date
-            )
-            
-            # group to the session
-            db.add(new_group)
-            db.commit()  # Commit to generate group_id
+    plan, errors = plan_group(create_group_data, dt.datetime.now(dt.timezone.utc))
+    async with SessionLocal() as db:
+        errors += (await membership_errors(db, [group_usernames(create_group_data)]))[0]
+        if errors:
+            raise HTTPException(status_code=400, detail=errors)
+        await commit_groups(db, [plan])
 
-            # Get the newly created group with the generated group_id
-            db.refresh(new_group)
+    return {"message": "Group created successfully", "group_id": plan.group_id}
+
+@app.post("/create-groups")
+async def create_groups(create_groups_data: CreateGroupsData):
+    """
+    Create many groups at once, for cohort onboarding. Either every group is created or, when any of them is
+    invalid, none are and the errors of every group are returned by index.
+    """
+    if len(create_groups_data.groups) > CREATE_GROUPS_MAX:
+        raise HTTPException(status_code=413, detail=f"At most {CREATE_GROUPS_MAX} groups per request")
 
-            # Add users (including owner and members) to the group
-            for member in group_members:
-                new_group.users.append(member)
+    now = dt.datetime.now(dt.timezone.utc)
+    planned = [plan_group(data, now) for data in create_groups_data.groups]
+    async with SessionLocal() as db:
+        membership = await membership_errors(db, [group_usernames(data) for data in create_groups_data.groups])
+        errors = [
+            {"index": index, "errors": plan_errors + member_errors}
+            for index, ((plan, plan_errors), member_errors) in enumerate(zip(planned, membership))
+            if plan_errors or member_errors
+        ]
+        if errors:
+            raise HTTPException(status_code=400, detail=errors)
+        plans = [plan for plan, _ in planned]
+        await commit_groups(db, plans)
 
-            # Commit the changes
-            db.commit()
-            db.refresh(new_group) 
-        except Exception as e:
-            db.rollback()
-            raise HTTPException(status_code=500, detail=f"Failed create a group: {e}")
-        
-        group_websockets[new_group.group_id] = GroupWebSocket(new_group.group_id)
-        
-    return {"message": "Group created successfully"}
+    return {"message": f"{len(plans)} groups created successfully", "group_ids": [plan.group_id for plan in plans]}
 
 @app.post("/my-group")
 async def my_group(username: str = Form(...)):
-    with SessionLocal() as db:
-        if (user := find_user(db, username)) is None:
-            raise HTTPException(status_code=500, detail=f"User does not exist: {username}")
-        if not (groups := user.groups):
-            return {
-                "message": f"{username} is not in a group",
-                "in_group": False
-            }
+    if (user := await snapshots.get_user(username)) is None:
+        raise HTTPException(status_code=500, detail=f"User does not exist: {username}")
+    if user.group_id is None or (group := await snapshots.get_group(user.group_id)) is None:
+        return {
+            "message": f"{username} is not in a group",
+            "in_group": False
+        }
+
+    return {
+        "group_id": group.group_id,
+        "owner_username": group.owner_username,
+        "group_members": list(group.members),
+        "to_sleep_time": group.to_sleep_time.strftime("%H:%M:%S"),
+        "to_wake_up_time": group.to_wake_up_time.strftime("%H:%M:%S"),
+        "duration_days": group.duration_days,
+        "days_remaining": group.days_remaining,
+        "start_date": group.start_date.strftime("%Y-%m-%d")
+    }        
 
-        group = groups[0]
 
-        return {
-            "group_id": group.group_id,
-            "owner_username": group.owner_username,
-            "group_members": [user.username for user in group.users],
-            "to_sleep_time": group.to_sleep_time.strftime("%H:%M:%S"),
-            "to_wake_up_time": group.to_wake_up_time.strftime("%H:%M:%S"),
-            "duration_days": group.duration_days,
-            "days_remaining": group.days_remaining,
-            "start_date": group.start_date.strftime("%Y-%m-%d")
-        }        
-
-
-@dataclass
-class BroadcastMessage:
-    operation: str
-    username: str
-    data: dict
+bus = create_bus(
+    BROADCAST_BACKEND,
+    dsn=engine.url.set(drivername="postgresql").render_as_string(hide_password=False),
+    ssl=DB_SSL
+)
+# websockets connected to this process, broadcasts from any node reach them through the bus
+group_websockets: Dict[str, GroupWebSocket] = {}
 
-    def to_string(self):
-        return json.dumps({
-            "operation": self.operation,
-            "username": self.username,
-            "message": self.data
-        })
 
+async def load_presence(group_id: str) -> Dict[str, bool]:
+    async with SessionLocal() as db:
+        result = await db.execute(
+            select(UserModel.username, UserModel.is_asleep)
+            .join(user_group_association, user_group_association.c.user_id == UserModel.username)
+            .filter(user_group_association.c.group_id == group_id)
+        )
+        return dict(result.all())
 
-class GroupWebSocket:
-    def __init__(self, room_id):
-        self.room_id = room_id
-        self.connections: List[WebSocket] = []
+presences = PresenceTracker(load_presence, replay_size=PRESENCE_REPLAY_SIZE, max_groups=PRESENCE_MAX_GROUPS)
 
-    async def broadcast(self, broadcast_message: BroadcastMessage):
-        disconnected_connections = []
-        for connection in self.connections:
-            try:
-                await connection.send_text(broadcast_message.to_string())
-            except Exception as e:
-                disconnected_connections.append(connection)
 
-        # Remove disconnected connections
-        for conn in disconnected_connections:
-            self.connections.remove(conn)
+def get_group_socket(group_id: str) -> GroupWebSocket:
+    if (group_socket := group_websockets.get(group_id)) is None:
+        group_socket = group_websockets[group_id] = GroupWebSocket(
+            group_id,
+            bus,
+            queue_size=WS_QUEUE_SIZE,
+            send_timeout=WS_SEND_TIMEOUT,
+            coalesce=WS_COALESCE
+        )
+    return group_socket
+
+
+async def deliver_broadcast(group_id: str, payload: str):
+    payload = presences.stamp(group_id, payload)
+    if (group_socket := group_websockets.get(group_id)) is not None:
+        await group_socket.deliver(payload)
+
+bus.subscribe(deliver_broadcast)
+
+
+async def broadcast_to_group(group_id: str, broadcast_message: BroadcastMessage):
+    with stage("broadcast"):
+        await bus.publish(group_id, broadcast_message.to_string())
 
-group_websockets = {}
 
 @app.websocket('/ws/{username}')
-async def websocket_endpoint(websocket: WebSocket, username: str):
-    group = None
-    with SessionLocal() as db:
-        if (user := find_user(db, username)) is None:
-            raise HTTPException(status_code=500, detail=f"User does not exist: {username}")
-        if not (groups := user.groups):
-            raise HTTPException(status_code=500, detail=f"{username} is not in a group")
-        group = groups[0]
+async def websocket_endpoint(
+    websocket: WebSocket,
+    username: str,
+    since: Optional[int] = None,
+    epoch: Optional[str] = None
+):
+    """
+    Group broadcasts for one member. The first message is a presence snapshot, or, when `since` and `epoch` are
+    the last `seq` and `epoch` the client received from this worker, the broadcasts it missed while away.
+    """
+    if (user := await snapshots.get_user(username)) is None:
+        raise WebSocketException(code=status.WS_1008_POLICY_VIOLATION, reason=f"User does not exist: {username}")
+    if user.group_id is None:
+        raise WebSocketException(code=status.WS_1008_POLICY_VIOLATION, reason=f"{username} is not in a group")
     
-    group_id = group.group_id
+    group_id = user.group_id
+    await websocket.accept()
+    group_presence = await presences.track(group_id)
+    # nothing is awaited from here on until the connection is registered, so no broadcast falls in between
+    missed = presences.connect(group_presence, since, epoch, WS_QUEUE_SIZE - 1)
+    group_socket = get_group_socket(group_id)
+    connection = group_socket.connect(websocket)
+    for payload in missed:
+        connection.offer(payload)
     try:
-        await websocket.accept()
-        if group_id not in group_websockets:
-            raise HTTPException(status_code=500, detail=f"group_id does not exist!")
-
-        group_socket = group_websockets[group_id]
-        group_socket.connections.append(websocket)
-
         while True:
             data = await websocket.receive_text()
-            await group_socket.broadcast(data, websocket)
-
+            await bus.publish(group_id, strip_reserved(data))
     except WebSocketDisconnect:
-        group_socket = group_websockets.get(group_id)
-        if group_socket:
-            # Remove the WebSocket connection from the room
-            group_socket.connections.remove(websocket)
-            # Clean up the room if it's empty
-            if not group_socket.connections:
-                del group_websockets[group_websockets]
+        pass
+    finally:
+        # Remove the WebSocket connection from the room
+        await group_socket.disconnect(connection)
+        # Clean up the room if it's empty
+        if not group_socket.connections and group_websockets.get(group_id) is group_socket:
+            del group_websockets[group_id]
+
+
+
+
+
+
+async def wait_for_model(poll: float = 0.25):
+    """
+    Return once the preloaded model can serve prompts, or once loading failed and templates took over.
+    """
+    while not inference.is_loaded:
+        if isinstance(inference, InferenceClient):
+            try:
+                await inference.refresh_status()
+            except Exception as e:
+                log.debug(f"inference server not answering yet: {e}")
+        await asyncio.sleep(poll)
+
+async def generate_message(prompt: str) -> str:
+    """
+    Generate flavour text for a state change on the inference worker, batched with any other pending prompts.
+    """
+    with stage("generate"):
+        return await inference.generate(prompt, max_new_tokens=25)
+
+
+message_cache = MessageCache(
+    generate_message,
+    maxsize=MESSAGE_CACHE_SIZE,
+    ttl=MESSAGE_CACHE_TTL,
+    bucket_minutes=MESSAGE_CACHE_BUCKET_MINUTES,
+    is_idle=lambda: inference.qsize() == 0
+)
+
+
+async def announce_state_change(
+    background_tasks: BackgroundTasks,
+    group_id: str,
+    operation: str,
+    username: str,
+    timestamp: dt.datetime,
+    data: Optional[dict] = None,
+    presence: Optional[dict] = None
+) -> dict:
+    """
+    Broadcast a committed state change to the group and build the endpoint response. `presence` is what the change
+    did to who is asleep, only the first broadcast carries it.
+
+    Messages come from the message cache when possible. On a miss with DEFER_MESSAGES the prompt itself is used
+    as a templated message and the generated text follows as a `message-ready` broadcast carrying the same
+    event_id, so the request never waits on the model. Generation only starts when the generation budget has
+    room and is given up after its deadline, in both cases the templated message is all the group gets.
+    """
+    data = data or {}
+    message = message_cache.lookup(operation, username, timestamp)
+    if message is None and not DEFER_MESSAGES:
+        if generation.try_acquire():
+            message = await generation.run(message_cache.generate(operation, username, timestamp))
+        if message is None:
+            message = message_cache.render(operation, username, timestamp)
+    if message is not None:
+        await broadcast_to_group(group_id, BroadcastMessage(operation, username, {"message": message, **data}, presence))
+        return {"message": message}
+
+    prompt = message_cache.render(operation, username, timestamp)
+    event_id = str(uuid.uuid4())
+    await broadcast_to_group(group_id, BroadcastMessage(
+        operation,
+        username,
+        {"message": prompt, "event_id": event_id, **data},
+        presence
+    ))
+    background_tasks.add_task(deliver_generated_message, group_id, operation, username, timestamp, event_id)
+    return {"message": prompt, "event_id": event_id}
+
+
+async def deliver_generated_message(
+    group_id: str,
+    operation: str,
+    username: str,
+    timestamp: dt.datetime,
+    event_id: str
+):
+    # over budget or past the deadline there is no message-ready, the templated message stands
+    if not generation.try_acquire():
+        return
+    message = await generation.run(message_cache.generate(operation, username, timestamp))
+    if message is None:
+        return
+
+    await broadcast_to_group(group_id, BroadcastMessage(
+        "message-ready",
+        username,
+        {"message": message, "event_id": event_id}
+    ))
+
+
+def track_advance(group: GroupModel, advance: Advance):
+    """
+    Bring a group loaded in the session, and its members, in line with what advance_group wrote, without marking
+    them changed.
+    """
+    members = list(group.users)
+    for member in members:
+        if member.username in advance.penalized:
+            set_committed_value(member, "score", advance.penalized[member.username])
+            set_committed_value(member, "current_snooze_counter", 0)
+    if advance.finished:
+        for member in members:
+            set_committed_value(member, "groups", [])
+        return
+    set_committed_value(group, "days_remaining", advance.days_remaining)
+    set_committed_value(group, "to_sleep_time", advance.next_sleep_time)
+    set_committed_value(group, "to_wake_up_time", advance.next_wake_up_time)
+
+
+def group_usernames(data: CreateGroupData) -> List[str]:
+    """
+    The members of a new group with the owner included, each once and in the order given.
+    """
+    return list(dict.fromkeys([*data.group_members, data.owner_username]))
+
+def plan_group(data: CreateGroupData, now: dt.datetime):
+    """
+    Check the schedule of a new group and work out its first night, returns the plan and every problem found.
+    Membership is checked separately since it needs the database.
+    """
+    errors = []
+    if data.duration_days < 1:
+        errors.append("Duration must be at least 1 day")
+    try:
+        if datetime_parser.isoparse(data.start_date) < now:
+            errors.append("Start date must be in the future")
+        if now > datetime_parser.isoparse(data.to_sleep_time):
+            errors.append("Cannot schedule a sleeping time in the past")
+
+        sleep_time = datetime_parser.isoparse(data.to_sleep_time).time()
+        wake_up_time = datetime_parser.isoparse(data.to_wake_up_time).time()
+        start_date = datetime_parser.isoparse(data.to_wake_up_time).date()
     except Exception as e:
-        raise HTTPException(status_code=500, detail="some errors")
+        errors.append(f"Invalid ISO 8601 format for sleep, wake or start: {e}")
+        return None, errors
 
+    if wake_up_time >= sleep_time: # sleep and wake up on the same day
+        sleep_time = dt.datetime.combine(start_date, sleep_time)
+        wake_up_time = dt.datetime.combine(start_date, wake_up_time)
+    else:
+        sleep_time = dt.datetime.combine(start_date, sleep_time)
+        wake_up_time = dt.datetime.combine(start_date + dt.timedelta(days=1), wake_up_time)
 
+    return GroupPlan(
+        owner_username=data.owner_username,
+        usernames=group_usernames(data),
+        to_sleep_time=sleep_time,
+        to_wake_up_time=wake_up_time,
+        duration_days=data.duration_days,
+        start_date=start_date
+    ), errors
 
+async def commit_groups(db, plans: List[GroupPlan]):
+    """
+    Insert validated groups with their members in one transaction, then bring every cache up to date.
+    """
+    try:
+        await insert_groups(db, plans)
+        with stage("commit"):
+            await db.commit()
+    except IntegrityError as e:
+        await db.rollback()
+        raise HTTPException(status_code=409, detail=f"Failed create a group, a member changed meanwhile: {e.orig}")
+    except Exception as e:
+        await db.rollback()
+        raise HTTPException(status_code=500, detail=f"Failed create a group: {e}")
 
+    for plan in plans:
+        snapshots.invalidate_group(plan.group_id, plan.usernames)
+        for username in plan.usernames:
+            leaderboards.set_group(username, plan.group_id)
+        scheduler.schedule(plan.group_id, plan.to_sleep_time, plan.to_wake_up_time)
+        get_group_socket(plan.group_id)
 
+def night_of(user: UserModel, group: GroupModel, snoozes: int) -> SleepSession:
+    """
+    The night a user who just woke up slept, measured against their group's goals at the time.
+    """
+    return SleepSession(
+        username=user.username,
+        group_id=group.group_id,
+        slept_at=user.last_sleep_time,
+        woke_at=user.last_awake_time,
+        snoozes=snoozes,
+        sleep_goal=group.to_sleep_time,
+        wake_goal=group.to_wake_up_time
+    )
 
-def find_user(db: sessionmaker, username: str) -> Optional[UserModel]:
-    return db.query(UserModel).options(joinedload(UserModel.groups)).filter(UserModel.username == username).first()
 
+def parse_client_time(timestamp: str) -> dt.datetime:
+    """
+    Parse an ISO 8601 time from a client into naive UTC, times without an offset are taken to be UTC already.
+    """
+    try:
+        parsed = datetime_parser.isoparse(timestamp)
+    except (ValueError, OverflowError) as e:
+        raise ValueError(f"Invalid ISO 8601 timestamp {timestamp}: {e}")
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(dt.timezone.utc).replace(tzinfo=None)
+    return parsed
 
+
+def utcnow() -> dt.datetime:
+    """
+    Current UTC time without tzinfo, which is how the DateTime columns store it.
+    """
+    return dt.datetime.now(dt.timezone.utc).replace(tzinfo=None)
+
+
+#############
+# SCHEDULER #
+#############
+
+async def nudge_group(group_id: str, operation: str, data: dict):
+    # every node runs its own scheduler, so nudges only go to the websockets held here
+    await deliver_broadcast(group_id, BroadcastMessage(operation, "snuz", data).to_string())
+
+
+async def handle_rollover(result: RolloverResult):
+    for username, score in result.penalized.items():
+        snapshots.invalidate_user(username)
+        leaderboards.update(username, score)
+
+    for group_id, members in result.members.items():
+        snapshots.invalidate_group(group_id, members)
+        finished = group_id in result.finished
+        if finished:
+            leaderboards.remove_group(group_id)
+        await broadcast_to_group(group_id, BroadcastMessage(
+            "rollover",
+            "snuz",
+            {
+                "days_remaining": 0 if finished else result.advanced[group_id][2],
+                "finished": finished,
+                "penalized": [username for username in members if username in result.penalized]
+            },
+            # oversleepers were woken up, the others were awake already
+            presence={
+                "awake": [username for username in members if username in result.penalized],
+                "finished": finished
+            }
+        ))
+        if finished:
+            group_websockets.pop(group_id, None)
+
+
+scheduler = DeadlineScheduler(
+    SessionLocal,
+    nudge=nudge_group,
+    on_rollover=handle_rollover,
+    clock=utcnow,
+    oversleep_grace=dt.timedelta(minutes=OVERSLEEP_GRACE_MINUTES),
+    oversleep_penalty=OVERSLEEP_PENALTY
+)
@@ -0,0 +1,118 @@
+import asyncio
+import datetime as dt
+import logging
+import random
+from typing import Awaitable, Callable, List, Optional
+
+from caching import TTLCache
+
+
+log = logging.getLogger(__name__)
+
+TEMPLATES = {
+    "to-sleep": "{username} went to sleep at {time}",
+    "to-awake": "{username} woke up at {time}",
+    "to-snooze": "{username} let down their team by hitting snooze at {time}"
+}
+
+# stands in for the username when warming entries that are shared by everyone
+PLACEHOLDER_USERNAME = "Someone"
+
+
+class MessageCache:
+    """
+    Cache of generated continuations for the sleep/wake/snooze prompt templates.
+
+    Entries are keyed on (template, time bucket, username) where a username of None is an entry shared by all
+    users. Only the text the model added after the prompt is stored, so a hit is rendered by putting the real
+    username and timestamp in front of a cached continuation.
+    """
+
+    def __init__(
+        self,
+        generate: Callable[[str], Awaitable[str]],
+        maxsize: int = 1024,
+        ttl: float = 6 * 60 * 60,
+        bucket_minutes: int = 60,
+        variants: int = 3,
+        is_idle: Callable[[], bool] = lambda: True
+    ):
+        self._generate = generate
+        self.cache = TTLCache(maxsize, ttl)
+        self.bucket_size = dt.timedelta(minutes=bucket_minutes)
+        self.variants = variants
+        self.is_idle = is_idle
+
+    def bucket(self, timestamp: dt.datetime) -> dt.datetime:
+        timestamp = timestamp.replace(tzinfo=None)
+        return dt.datetime.min + ((timestamp - dt.datetime.min) // self.bucket_size) * self.bucket_size
+
+    @staticmethod
+    def render(template: str, username: str, timestamp: dt.datetime) -> str:
+        return TEMPLATES[template].format(username=username, time=timestamp)
+
+    def lookup(self, template: str, username: str, timestamp: dt.datetime) -> Optional[str]:
+        """
+        Return a finished message from the cache, preferring an entry generated for this user, or None on a miss.
+        """
+        bucket = self.bucket(timestamp)
+        # one hit or miss per lookup, whichever entry answers it
+        key = (template, bucket, username)
+        if key not in self.cache:
+            key = (template, bucket, None)
+        continuations = self.cache.get(key)
+        if not continuations:
+            return None
+        return self.render(template, username, timestamp) + random.choice(continuations)
+
+    async def generate(self, template: str, username: str, timestamp: dt.datetime) -> str:
+        """
+        Run the model for this exact prompt and keep the result for the user's time bucket.
+        """
+        prompt = self.render(template, username, timestamp)
+        continuation = self._continuation(prompt, await self._generate(prompt))
+        self._add_variant((template, self.bucket(timestamp), username), continuation)
+        return prompt + continuation
+
+    async def warm(self, now: dt.datetime, buckets: int = 2):
+        """
+        Fill the shared entries of every template for the bucket containing `now` and the ones after it.
+        """
+        jobs = []
+        for offset in range(buckets):
+            bucket = self.bucket(now) + offset * self.bucket_size
+            for template in TEMPLATES:
+                key = (template, bucket, None)
+                missing = self.variants - len(self.cache.peek(key, []))
+                jobs.extend(self._warm_variant(template, bucket) for _ in range(missing))
+        if jobs:
+            await asyncio.gather(*jobs)
+            log.debug(f"warmed {len(jobs)} cached messages")
+
+    async def run_warmer(self, clock: Callable[[], dt.datetime], interval: float = 60):
+        """
+        Keep the upcoming buckets warm whenever the model has nothing else to do.
+        """
+        while True:
+            if self.is_idle():
+                try:
+                    await self.warm(clock())
+                except Exception as e:
+                    log.error(f"failed to warm the message cache: {e}")
+            await asyncio.sleep(interval)
+
+    async def _warm_variant(self, template: str, bucket: dt.datetime):
+        prompt = self.render(template, PLACEHOLDER_USERNAME, bucket)
+        continuation = self._continuation(prompt, await self._generate(prompt))
+        self._add_variant((template, bucket, None), continuation)
+
+    def _add_variant(self, key: tuple, continuation: str):
+        continuations: List[str] = list(self.cache.peek(key, []))
+        if len(continuations) >= self.variants:
+            continuations.pop(0)
+        continuations.append(continuation)
+        self.cache.set(key, continuations)
+
+    @staticmethod
+    def _continuation(prompt: str, generated_text: str) -> str:
+        return generated_text[len(prompt):] if generated_text.startswith(prompt) else " " + generated_text
@@ -0,0 +1,220 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+import threading
+import time
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple, Union
+
+
+# seconds, from a fast cache hit up to a model call stuck behind a full batch
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# requests sending this header with the value 1 get their stage breakdown back in a Server-Timing header
+PROFILE_REQUEST_HEADER = b"x-snuz-profile"
+
+INF_BOUND = 'le="+Inf"'
+
+GaugeValue = Union[float, Dict[Tuple[str, ...], float]]
+
+
+def _labels(labelnames: Sequence[str], labelvalues: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, labelvalues)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Histogram:
+    """
+    Cumulative histogram per label combination, safe to observe from the inference thread.
+    """
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # label values -> (per bucket counts with +Inf last, sum)
+        self._series: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labelvalues: str):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            if (series := self._series.get(labelvalues)) is None:
+                series = self._series[labelvalues] = ([0] * (len(self.buckets) + 1), [0.0])
+            counts, total = series
+            counts[index] += 1
+            total[0] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = [(labelvalues, list(counts), total[0]) for labelvalues, (counts, total) in self._series.items()]
+        for labelvalues, counts, total in sorted(series):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                labels = _labels(self.labelnames, labelvalues, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            cumulative += counts[-1]
+            lines.append(f"{self.name}_bucket{_labels(self.labelnames, labelvalues, INF_BOUND)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labelvalues)} {total}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labelvalues)} {cumulative}")
+        return lines
+
+
+class Gauge:
+    """
+    Value read at scrape time, `callback` returns a number or, with labels, a dict of label values to numbers.
+    """
+
+    def __init__(self, name: str, help: str, callback: Callable[[], GaugeValue], labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.callback = callback
+        self.labelnames = tuple(labelnames)
+
+    type = "gauge"
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        value = self.callback()
+        if not self.labelnames:
+            lines.append(f"{self.name} {value}")
+            return lines
+        for labelvalues, sample in sorted(value.items()):
+            lines.append(f"{self.name}{_labels(self.labelnames, labelvalues)} {sample}")
+        return lines
+
+
+class Counter(Gauge):
+    """
+    Running total read at scrape time, `callback` must only ever go up while the process lives. Names end in _total.
+    """
+
+    type = "counter"
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: List[Union[Histogram, Gauge]] = []
+
+    def histogram(self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        histogram = Histogram(name, help, labelnames, buckets)
+        self.metrics.append(histogram)
+        return histogram
+
+    def gauge(self, name: str, help: str, callback: Callable[[], GaugeValue], labelnames: Sequence[str] = ()) -> Gauge:
+        gauge = Gauge(name, help, callback, labelnames)
+        self.metrics.append(gauge)
+        return gauge
+
+    def counter(self, name: str, help: str, callback: Callable[[], GaugeValue], labelnames: Sequence[str] = ()) -> Counter:
+        counter = Counter(name, help, callback, labelnames)
+        self.metrics.append(counter)
+        return counter
+
+    def render(self) -> str:
+        """
+        Every metric in the Prometheus text exposition format.
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+STAGE_SECONDS = registry.histogram("snuz_stage_seconds", "Time spent in each hot path stage", ("stage",))
+
+
+class Profile:
+    """
+    Stage timings collected for one profiled request.
+    """
+
+    def __init__(self):
+        self.stages: Dict[str, float] = {}
+
+    def add(self, stage: str, seconds: float):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def server_timing(self, total: float) -> str:
+        entries = [f"{stage};dur={seconds * 1000:.2f}" for stage, seconds in self.stages.items()]
+        entries.append(f"total;dur={total * 1000:.2f}")
+        return ", ".join(entries)
+
+
+_profile: ContextVar[Optional[Profile]] = ContextVar("profile", default=None)
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """
+    Time a block into the stage histogram and the current request's profile, if it is being profiled.
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        STAGE_SECONDS.observe(elapsed, name)
+        if (profile := _profile.get()) is not None:
+            profile.add(name, elapsed)
+
+
+class MetricsMiddleware:
+    """
+    Records every HTTP request in a latency histogram by method, route and status, and answers profiled requests
+    with a Server-Timing header. Stages that finish after the response has started, such as background tasks,
+    only show up in the histograms.
+    """
+
+    def __init__(self, app, request_seconds: Histogram, profiling: bool = False):
+        self.app = app
+        self.request_seconds = request_seconds
+        self.profiling = profiling
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        profile = None
+        if self.profiling and (PROFILE_REQUEST_HEADER, b"1") in scope["headers"]:
+            profile = Profile()
+        token = _profile.set(profile)
+        started = time.perf_counter()
+        status_code = 500
+        observed = False
+
+        def observe():
+            nonlocal observed
+            observed = True
+            # the route template keeps the label count bounded, unmatched paths share one series
+            route = getattr(scope.get("route"), "path", "unmatched")
+            self.request_seconds.observe(time.perf_counter() - started, scope["method"], route, str(status_code))
+
+        async def send_with_timing(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                if profile is not None:
+                    timing = profile.server_timing(time.perf_counter() - started)
+                    message = {**message, "headers": [*message.get("headers", []), (b"server-timing", timing.encode())]}
+            await send(message)
+            # background tasks run after the last body chunk and do not count towards the request
+            if message["type"] == "http.response.body" and not message.get("more_body", False):
+                observe()
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _profile.reset(token)
+            if not observed:
+                observe()
@@ -0,0 +1,167 @@
+import asyncio
+from collections import OrderedDict, deque
+import json
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+import uuid
+
+
+# envelope keys only the server may set, they are stripped from messages relayed for clients
+RESERVED_KEYS = ("seq", "epoch", "presence")
+
+Loader = Callable[[str], Awaitable[Dict[str, bool]]]
+
+
+class GroupPresence:
+    """
+    Who in a group is asleep as seen by this node, and the last `replay_size` broadcasts it delivered to the group.
+
+    Every delivered broadcast gets the next sequence number. Sequence numbers only mean something together with
+    `epoch`, which is new for every GroupPresence, so a client coming back to another node, or to this one after
+    the group was evicted, gets a snapshot instead of a wrong replay.
+    """
+
+    def __init__(self, group_id: str, replay_size: int):
+        self.group_id = group_id
+        self.epoch = uuid.uuid4().hex[:12]
+        self.seq = 0
+        self.members: Dict[str, bool] = {}
+        self.loading: Optional[asyncio.Future] = None
+        # (seq, payload, presence delta)
+        self._replay: Deque[Tuple[int, str, Optional[dict]]] = deque(maxlen=replay_size)
+
+    def record(self, envelope: dict) -> str:
+        self.seq += 1
+        envelope["seq"] = self.seq
+        envelope["epoch"] = self.epoch
+        delta = envelope.get("presence")
+        if delta:
+            self._apply(delta)
+        payload = json.dumps(envelope)
+        self._replay.append((self.seq, payload, delta))
+        return payload
+
+    def load(self, members: Dict[str, bool]):
+        """
+        Start from the members' state in the database, then re-apply the deltas delivered while it was being read.
+        Deltas set absolute states, so applying one the read already saw changes nothing.
+        """
+        self.members = dict(members)
+        for _, _, delta in self._replay:
+            if delta:
+                self._apply(delta)
+
+    def catch_up(self, since: Optional[int], epoch: Optional[str], limit: int) -> Optional[List[str]]:
+        """
+        The broadcasts sent after `since`, or None when they cannot all be replayed and a snapshot is needed.
+        `since` is only trusted together with the `epoch` it was received in.
+        """
+        if since is None or epoch != self.epoch or since > self.seq:
+            return None
+        oldest = self._replay[0][0] if self._replay else self.seq + 1
+        if since + 1 < oldest or self.seq - since > limit:
+            return None
+        return [payload for seq, payload, _ in self._replay if seq > since]
+
+    def snapshot(self) -> str:
+        return json.dumps({
+            "operation": "presence",
+            "username": "snuz",
+            "message": {
+                "asleep": sorted(username for username, is_asleep in self.members.items() if is_asleep),
+                "awake": sorted(username for username, is_asleep in self.members.items() if not is_asleep)
+            },
+            "seq": self.seq,
+            "epoch": self.epoch
+        })
+
+    def _apply(self, delta: dict):
+        for username in delta.get("asleep", ()):
+            self.members[username] = True
+        for username in delta.get("awake", ()):
+            self.members[username] = False
+
+
+class PresenceTracker:
+    """
+    Presence of the groups this node has held websockets for, least recently connected groups are evicted first.
+
+    Broadcasts carry only what changed in their `presence` field, e.g. {"asleep": ["alice"]}, and every node keeps
+    its own sequence numbers as it delivers them, whichever node they were published on.
+    """
+
+    def __init__(self, loader: Loader, replay_size: int = 256, max_groups: int = 10000):
+        self.loader = loader
+        self.replay_size = replay_size
+        self.max_groups = max_groups
+        self.replays = 0
+        self.snapshots = 0
+        self._groups: "OrderedDict[str, GroupPresence]" = OrderedDict()
+
+    async def track(self, group_id: str) -> GroupPresence:
+        """
+        The presence of a group, read from the database the first time and kept up to date from broadcasts after.
+        """
+        if (presence := self._groups.get(group_id)) is None:
+            presence = self._groups[group_id] = GroupPresence(group_id, self.replay_size)
+            presence.loading = asyncio.ensure_future(self._load(presence))
+            while len(self._groups) > self.max_groups:
+                self._groups.popitem(last=False)
+        self._groups.move_to_end(group_id)
+        await asyncio.shield(presence.loading)
+        return presence
+
+    def connect(self, presence: GroupPresence, since: Optional[int], epoch: Optional[str], limit: int) -> List[str]:
+        """
+        What a (re)connecting client needs before live broadcasts: the ones it missed, or a snapshot.
+        """
+        if (missed := presence.catch_up(since, epoch, limit)) is not None:
+            self.replays += 1
+            return missed
+        self.snapshots += 1
+        return [presence.snapshot()]
+
+    def stamp(self, group_id: str, payload: str) -> str:
+        """
+        Number a broadcast about to be delivered to a tracked group and keep it for replays.
+        """
+        if (presence := self._groups.get(group_id)) is None:
+            return payload
+        try:
+            envelope = json.loads(payload)
+        except ValueError:
+            return payload
+        if not isinstance(envelope, dict):
+            return payload
+        payload = presence.record(envelope)
+        if (envelope.get("presence") or {}).get("finished"):
+            self.drop(group_id)
+        return payload
+
+    def drop(self, group_id: str):
+        self._groups.pop(group_id, None)
+
+    def stats(self) -> Dict[str, int]:
+        return {"groups": len(self._groups), "replays": self.replays, "snapshots": self.snapshots}
+
+    async def _load(self, presence: GroupPresence):
+        try:
+            presence.load(await self.loader(presence.group_id))
+        except Exception:
+            if self._groups.get(presence.group_id) is presence:
+                del self._groups[presence.group_id]
+            raise
+
+
+def strip_reserved(payload: str) -> str:
+    """
+    Remove the server only envelope keys from a message a client sent for the group, so it cannot forge presence.
+    """
+    try:
+        envelope = json.loads(payload)
+    except ValueError:
+        return payload
+    if not isinstance(envelope, dict) or not any(key in envelope for key in RESERVED_KEYS):
+        return payload
+    for key in RESERVED_KEYS:
+        envelope.pop(key, None)
+    return json.dumps(envelope)
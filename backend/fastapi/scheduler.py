@@ -0,0 +1,293 @@
+import asyncio
+from dataclasses import dataclass, field
+import datetime as dt
+import heapq
+import itertools
+import logging
+from typing import Awaitable, Callable, Dict, List, Tuple
+
+from sqlalchemy import bindparam, case, delete, select, update
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from database import MIN_SCORE, GroupModel, UserModel, user_group_association
+
+
+log = logging.getLogger(__name__)
+
+# a member whose last sleep started this long before the group's bedtime did not sleep that night
+MISSED_SLEEP_WINDOW = dt.timedelta(hours=12)
+
+
+def next_group_times(
+    start_date: dt.date,
+    duration_days: int,
+    days_remaining: int,
+    to_sleep_time: dt.datetime,
+    to_wake_up_time: dt.datetime
+) -> Tuple[dt.datetime, dt.datetime]:
+    """
+    Sleep and wake up times of the night after a rollover, `days_remaining` already counts that night.
+    """
+    date_diff = duration_days - days_remaining
+    new_start_date = start_date + dt.timedelta(days=date_diff)
+    new_wake_up_time = to_wake_up_time.time()
+    new_sleep_time = to_sleep_time.time()
+
+    sleep_time = dt.datetime.combine(new_start_date, new_sleep_time)
+    if new_wake_up_time >= new_sleep_time: # sleep and wake up on the same day
+        return sleep_time, dt.datetime.combine(new_start_date, new_wake_up_time)
+    return sleep_time, dt.datetime.combine(new_start_date + dt.timedelta(days=1), new_wake_up_time)
+
+
+@dataclass
+class RolloverResult:
+    advanced: Dict[str, Tuple[dt.datetime, dt.datetime, int]] = field(default_factory=dict)
+    finished: List[str] = field(default_factory=list)
+    members: Dict[str, List[str]] = field(default_factory=dict)
+    penalized: Dict[str, int] = field(default_factory=dict)
+
+
+class DeadlineScheduler:
+    """
+    Time ordered index of every group's sleep and wake deadlines.
+
+    Each group has three deadlines a night: a sleep nudge at bedtime, a wake nudge at wake up time, and a rollover
+    `oversleep_grace` after wake up time. Nudges are sent to the websockets held by this process. Rollovers for all
+    groups due in the same tick happen in one transaction: members still asleep or who never went to sleep lose
+    `oversleep_penalty` points and oversleepers are woken up, then the groups advance to the next night or are
+    deleted when their challenge is over. Groups that already rolled over through /to-awake are not due anymore.
+
+    Every worker keeps its own index. Groups that another worker moved on or deleted are re-read when their
+    rollover finds nothing to do, and `run_reloader` rebuilds the index now and then to pick up groups created
+    elsewhere.
+    """
+
+    def __init__(
+        self,
+        session_factory: async_sessionmaker,
+        nudge: Callable[[str, str, dict], Awaitable[None]],
+        on_rollover: Callable[[RolloverResult], Awaitable[None]],
+        clock: Callable[[], dt.datetime],
+        oversleep_grace: dt.timedelta = dt.timedelta(hours=1),
+        oversleep_penalty: int = 10,
+        max_sleep: float = 60
+    ):
+        self.session_factory = session_factory
+        self.nudge = nudge
+        self.on_rollover = on_rollover
+        self.clock = clock
+        self.oversleep_grace = oversleep_grace
+        self.oversleep_penalty = oversleep_penalty
+        self.max_sleep = max_sleep
+        self._heap: List[Tuple[dt.datetime, int, str, str]] = []
+        self._deadlines: Dict[str, Tuple[dt.datetime, dt.datetime]] = {}
+        self._sequence = itertools.count()
+        self._changed = asyncio.Event()
+
+    def __len__(self) -> int:
+        return len(self._deadlines)
+
+    def schedule(self, group_id: str, to_sleep_time: dt.datetime, to_wake_up_time: dt.datetime):
+        """
+        Add a group or replace its deadlines, entries left in the heap for old deadlines are skipped when popped.
+        """
+        self._deadlines[group_id] = (to_sleep_time, to_wake_up_time)
+        now = self.clock()
+        if to_sleep_time > now:
+            self._push(to_sleep_time, group_id, "sleep")
+        if to_wake_up_time > now:
+            self._push(to_wake_up_time, group_id, "wake")
+        self._push(to_wake_up_time + self.oversleep_grace, group_id, "rollover")
+        self._changed.set()
+
+    def unschedule(self, group_id: str):
+        self._deadlines.pop(group_id, None)
+
+    async def load(self):
+        """
+        Rebuild the index from the groups table, at startup and then every reload.
+        """
+        async with self.session_factory() as db:
+            result = await db.execute(select(GroupModel.group_id, GroupModel.to_sleep_time, GroupModel.to_wake_up_time))
+            rows = result.all()
+        self._heap.clear()
+        self._deadlines.clear()
+        for group_id, to_sleep_time, to_wake_up_time in rows:
+            self.schedule(group_id, to_sleep_time, to_wake_up_time)
+
+    async def refresh(self, group_ids: List[str]):
+        """
+        Re-read the deadlines of groups that may have been moved on or deleted by another worker.
+        """
+        async with self.session_factory() as db:
+            result = await db.execute(
+                select(GroupModel.group_id, GroupModel.to_sleep_time, GroupModel.to_wake_up_time)
+                .filter(GroupModel.group_id.in_(group_ids))
+            )
+            found = {group_id: (to_sleep_time, to_wake_up_time) for group_id, to_sleep_time, to_wake_up_time in result}
+        for group_id in group_ids:
+            if (deadlines := found.get(group_id)) is None:
+                self.unschedule(group_id)
+            elif deadlines != self._deadlines.get(group_id):
+                self.schedule(group_id, *deadlines)
+            # unchanged deadlines mean another worker is rolling the group over right now, the next reload
+            # schedules it again if that did not go through
+
+    async def run_reloader(self, interval: float):
+        """
+        Periodically rebuild from the database to pick up groups created or moved on by other workers.
+        """
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.load()
+            except Exception as e:
+                log.error(f"failed to reload the scheduler: {e}")
+
+    async def run(self):
+        while True:
+            try:
+                await self.tick()
+            except Exception as e:
+                log.error(f"scheduler tick failed: {e}")
+
+            self._changed.clear()
+            timeout = self.max_sleep
+            if self._heap:
+                timeout = min(max((self._heap[0][0] - self.clock()).total_seconds(), 0), self.max_sleep)
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def tick(self):
+        """
+        Fire every deadline that is due.
+        """
+        now = self.clock()
+        # dicts as ordered sets, a group rescheduled with the same times has duplicate entries
+        due: Dict[str, Dict[str, None]] = {"sleep": {}, "wake": {}, "rollover": {}}
+        while self._heap and self._heap[0][0] <= now:
+            when, _, group_id, kind = heapq.heappop(self._heap)
+            if self._is_current(when, group_id, kind):
+                due[kind][group_id] = None
+
+        for group_id in due["sleep"]:
+            await self.nudge(group_id, "nudge-sleep", {"message": "Time for bed, the bear is watching"})
+        for group_id in due["wake"]:
+            await self.nudge(group_id, "nudge-wake", {"message": "Rise and shine, your team is counting on you"})
+        if due["rollover"]:
+            result = await self.roll_over(list(due["rollover"]), now)
+            for group_id, (to_sleep_time, to_wake_up_time, _) in result.advanced.items():
+                self.schedule(group_id, to_sleep_time, to_wake_up_time)
+            for group_id in result.finished:
+                self.unschedule(group_id)
+            rolled_over = set(result.advanced) | set(result.finished)
+            if stale := [group_id for group_id in due["rollover"] if group_id not in rolled_over]:
+                await self.refresh(stale)
+            await self.on_rollover(result)
+
+    async def roll_over(self, group_ids: List[str], now: dt.datetime) -> RolloverResult:
+        result = RolloverResult()
+        cutoff = now - self.oversleep_grace
+        async with self.session_factory() as db:
+            async with db.begin():
+                # rows another worker is already rolling over are skipped, as are groups that /to-awake advanced
+                groups = (await db.execute(
+                    select(GroupModel)
+                    .filter(GroupModel.group_id.in_(group_ids), GroupModel.to_wake_up_time <= cutoff)
+                    .with_for_update(skip_locked=True)
+                )).scalars().all()
+                if not groups:
+                    return result
+                bedtimes = {group.group_id: group.to_sleep_time for group in groups}
+
+                members = (await db.execute(
+                    select(
+                        user_group_association.c.group_id,
+                        UserModel.username,
+                        UserModel.is_asleep,
+                        UserModel.last_sleep_time
+                    )
+                    .join(UserModel, UserModel.username == user_group_association.c.user_id)
+                    .filter(user_group_association.c.group_id.in_(bedtimes))
+                )).all()
+                missed = []
+                for group_id, username, is_asleep, last_sleep_time in members:
+                    result.members.setdefault(group_id, []).append(username)
+                    bedtime = bedtimes[group_id]
+                    if is_asleep or last_sleep_time is None or last_sleep_time < bedtime - MISSED_SLEEP_WINDOW:
+                        missed.append(username)
+
+                if missed:
+                    penalized = await db.execute(
+                        update(UserModel)
+                        .filter(UserModel.username.in_(missed))
+                        .values(
+                            score=case(
+                                (UserModel.score - self.oversleep_penalty < MIN_SCORE, MIN_SCORE),
+                                else_=UserModel.score - self.oversleep_penalty
+                            ),
+                            is_asleep=False,
+                            last_awake_time=case((UserModel.is_asleep, now), else_=UserModel.last_awake_time),
+                            current_snooze_counter=0
+                        )
+                        .returning(UserModel.username, UserModel.score)
+                        .execution_options(synchronize_session=False)
+                    )
+                    result.penalized = dict(penalized.all())
+
+                advanced = []
+                for group in groups:
+                    if group.days_remaining - 1 <= 0: # end of sleep challenge
+                        result.finished.append(group.group_id)
+                        continue
+                    days_remaining = group.days_remaining - 1
+                    to_sleep_time, to_wake_up_time = next_group_times(
+                        group.start_date,
+                        group.duration_days,
+                        days_remaining,
+                        group.to_sleep_time,
+                        group.to_wake_up_time
+                    )
+                    result.advanced[group.group_id] = (to_sleep_time, to_wake_up_time, days_remaining)
+                    advanced.append({
+                        "b_group_id": group.group_id,
+                        "days_remaining": days_remaining,
+                        "to_sleep_time": to_sleep_time,
+                        "to_wake_up_time": to_wake_up_time
+                    })
+
+                # one executemany for every advancing group, one delete each for the finished ones
+                if advanced:
+                    await db.execute(
+                        update(GroupModel.__table__).where(GroupModel.__table__.c.group_id == bindparam("b_group_id")),
+                        advanced
+                    )
+                if result.finished:
+                    await db.execute(
+                        delete(user_group_association)
+                        .where(user_group_association.c.group_id.in_(result.finished))
+                    )
+                    await db.execute(
+                        delete(GroupModel.__table__).where(GroupModel.__table__.c.group_id.in_(result.finished))
+                    )
+
+        log.info(
+            f"rolled over {len(result.advanced)} groups, finished {len(result.finished)}, "
+            f"penalized {len(result.penalized)} users"
+        )
+        return result
+
+    def _push(self, when: dt.datetime, group_id: str, kind: str):
+        heapq.heappush(self._heap, (when, next(self._sequence), group_id, kind))
+
+    def _is_current(self, when: dt.datetime, group_id: str, kind: str) -> bool:
+        if (deadlines := self._deadlines.get(group_id)) is None:
+            return False
+        to_sleep_time, to_wake_up_time = deadlines
+        if kind == "sleep":
+            return when == to_sleep_time
+        if kind == "wake":
+            return when == to_wake_up_time
+        return when == to_wake_up_time + self.oversleep_grace
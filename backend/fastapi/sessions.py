@@ -0,0 +1,178 @@
+import asyncio
+from collections import deque
+from dataclasses import dataclass
+import datetime as dt
+import logging
+from typing import Deque, Dict, List, Optional
+
+from sqlalchemy import bindparam, insert, select, update
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from database import SleepSessionModel, SleepStatsModel
+
+
+log = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class SleepSession:
+    username: str
+    group_id: Optional[str]
+    slept_at: dt.datetime
+    woke_at: dt.datetime
+    snoozes: int
+    sleep_goal: Optional[dt.datetime] = None
+    wake_goal: Optional[dt.datetime] = None
+
+    @property
+    def minutes_slept(self) -> int:
+        return max(int((self.woke_at - self.slept_at).total_seconds() // 60), 0)
+
+
+class SessionRecorder:
+    """
+    Buffers finished nights in memory and appends them to sleep_sessions in batches, off the request path.
+
+    Each flush is one transaction: one multi-row insert of the sessions plus one executemany that adds the batch's
+    totals onto every user's sleep_stats row, so aggregates never have to be recomputed from the full history.
+    A failed flush keeps its sessions for the next attempt. Sessions still buffered when a process dies are lost,
+    at most `flush_interval` seconds worth.
+    """
+
+    def __init__(
+        self,
+        session_factory: async_sessionmaker,
+        flush_interval: float = 2,
+        max_batch: int = 500,
+        max_pending: int = 50000
+    ):
+        self.session_factory = session_factory
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.max_pending = max_pending
+        self.recorded = 0
+        self.written = 0
+        self.dropped = 0
+        self._pending: Deque[SleepSession] = deque()
+        self._full = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+
+    def record(self, session: SleepSession):
+        if len(self._pending) >= self.max_pending:
+            self._pending.popleft()
+            self.dropped += 1
+            log.warning("sleep session buffer is full, dropping the oldest session")
+        self._pending.append(session)
+        self.recorded += 1
+        if len(self._pending) >= self.max_batch:
+            self._full.set()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "pending": len(self._pending),
+            "recorded": self.recorded,
+            "written": self.written,
+            "dropped": self.dropped
+        }
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._full.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                log.error(f"failed to write sleep sessions, retrying with the next flush: {e}")
+
+    async def stop(self):
+        try:
+            await self.flush()
+        except Exception as e:
+            log.error(f"lost {len(self._pending)} sleep sessions at shutdown: {e}")
+
+    async def flush(self) -> int:
+        """
+        Write everything buffered so far, returns the number of sessions written.
+        """
+        async with self._flush_lock:
+            written = 0
+            while self._pending:
+                batch = [self._pending.popleft() for _ in range(min(self.max_batch, len(self._pending)))]
+                try:
+                    await self._write(batch)
+                except BaseException:
+                    # cancellation included, the batch is written by the next flush
+                    self._pending.extendleft(reversed(batch))
+                    raise
+                written += len(batch)
+            self.written += written
+            return written
+
+    async def _write(self, batch: List[SleepSession]):
+        totals: Dict[str, Dict] = {}
+        for session in batch:
+            minutes = session.minutes_slept
+            total = totals.setdefault(session.username, {
+                "b_username": session.username,
+                "b_nights": 0,
+                "b_minutes": 0,
+                "b_minutes_squared": 0,
+                "b_snoozes": 0,
+                "b_nights_snoozed": 0
+            })
+            total["b_nights"] += 1
+            total["b_minutes"] += minutes
+            total["b_minutes_squared"] += minutes * minutes
+            total["b_snoozes"] += session.snoozes
+            total["b_nights_snoozed"] += int(session.snoozes > 0)
+
+        stats = SleepStatsModel.__table__
+        async with self.session_factory() as db:
+            async with db.begin():
+                await db.execute(insert(SleepSessionModel), [
+                    {
+                        "username": session.username,
+                        "group_id": session.group_id,
+                        "slept_at": session.slept_at,
+                        "woke_at": session.woke_at,
+                        "minutes_slept": session.minutes_slept,
+                        "snoozes": session.snoozes,
+                        "sleep_goal": session.sleep_goal,
+                        "wake_goal": session.wake_goal
+                    }
+                    for session in batch
+                ])
+
+                existing = set((await db.execute(
+                    select(stats.c.username).where(stats.c.username.in_(totals))
+                )).scalars())
+                updates = [total for username, total in totals.items() if username in existing]
+                if updates:
+                    await db.execute(
+                        update(stats)
+                        .where(stats.c.username == bindparam("b_username"))
+                        .values(
+                            nights=stats.c.nights + bindparam("b_nights"),
+                            total_minutes=stats.c.total_minutes + bindparam("b_minutes"),
+                            total_minutes_squared=stats.c.total_minutes_squared + bindparam("b_minutes_squared"),
+                            total_snoozes=stats.c.total_snoozes + bindparam("b_snoozes"),
+                            nights_snoozed=stats.c.nights_snoozed + bindparam("b_nights_snoozed")
+                        ),
+                        updates
+                    )
+                inserts = [
+                    {
+                        "username": total["b_username"],
+                        "nights": total["b_nights"],
+                        "total_minutes": total["b_minutes"],
+                        "total_minutes_squared": total["b_minutes_squared"],
+                        "total_snoozes": total["b_snoozes"],
+                        "nights_snoozed": total["b_nights_snoozed"]
+                    }
+                    for username, total in totals.items() if username not in existing
+                ]
+                if inserts:
+                    await db.execute(insert(stats), inserts)
@@ -0,0 +1,158 @@
+import asyncio
+from dataclasses import dataclass
+import datetime as dt
+from typing import Awaitable, Callable, Dict, Hashable, Iterable, Optional, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from sqlalchemy.orm import selectinload
+
+from caching import TTLCache
+from database import GroupModel, UserModel, find_user
+
+
+@dataclass(frozen=True)
+class UserSnapshot:
+    username: str
+    owns_a_group: bool
+    group_id: Optional[str]
+    score: int
+    average_minutes_slept: Optional[int]
+    is_asleep: bool
+    last_sleep_time: Optional[dt.datetime]
+    last_awake_time: Optional[dt.datetime]
+    current_snooze_counter: int
+
+    @classmethod
+    def from_model(cls, user: UserModel) -> "UserSnapshot":
+        return cls(
+            username=user.username,
+            owns_a_group=user.owns_a_group,
+            group_id=None if not user.groups else user.groups[0].group_id,
+            score=user.score,
+            average_minutes_slept=user.average_minutes_slept,
+            is_asleep=user.is_asleep,
+            last_sleep_time=user.last_sleep_time,
+            last_awake_time=user.last_awake_time,
+            current_snooze_counter=user.current_snooze_counter
+        )
+
+
+@dataclass(frozen=True)
+class GroupSnapshot:
+    group_id: str
+    owner_username: Optional[str]
+    members: Tuple[str, ...]
+    to_sleep_time: dt.datetime
+    to_wake_up_time: dt.datetime
+    duration_days: int
+    days_remaining: int
+    start_date: dt.date
+
+    @classmethod
+    def from_model(cls, group: GroupModel) -> "GroupSnapshot":
+        return cls(
+            group_id=group.group_id,
+            owner_username=group.owner_username,
+            members=tuple(user.username for user in group.users),
+            to_sleep_time=group.to_sleep_time,
+            to_wake_up_time=group.to_wake_up_time,
+            duration_days=group.duration_days,
+            days_remaining=group.days_remaining,
+            start_date=group.start_date
+        )
+
+
+class SnapshotCache:
+    """
+    Read-through cache of immutable user and group snapshots for the polling endpoints.
+
+    Writers must call invalidate_user/invalidate_group after committing. A load that overlaps an invalidation is
+    returned to its caller but not stored, so a slow read can never put pre-write state back into the cache.
+    The cache is per process, other workers see a write once their entry's TTL runs out.
+    """
+
+    def __init__(self, session_factory: async_sessionmaker, maxsize: int = 10000, ttl: float = 10):
+        self.session_factory = session_factory
+        self.users = TTLCache(maxsize, ttl)
+        self.groups = TTLCache(maxsize, ttl)
+        self._epoch = 0
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+
+    async def get_user(self, username: str) -> Optional[UserSnapshot]:
+        if (snapshot := self.users.get(username)) is not None:
+            return snapshot
+        return await self._load(("user", username), lambda: self._load_user(username))
+
+    async def get_group(self, group_id: str) -> Optional[GroupSnapshot]:
+        if (snapshot := self.groups.get(group_id)) is not None:
+            return snapshot
+        return await self._load(("group", group_id), lambda: self._load_group(group_id))
+
+    def invalidate_user(self, *usernames: str):
+        self._epoch += 1
+        for username in usernames:
+            self.users.pop(username)
+
+    def invalidate_group(self, group_id: str, members: Iterable[str] = ()):
+        self._epoch += 1
+        self.groups.pop(group_id)
+        for username in members:
+            self.users.pop(username)
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        return {"users": self.users.stats(), "groups": self.groups.stats()}
+
+    async def _load(self, key: Hashable, loader: Callable[[], Awaitable]):
+        # concurrent misses for the same key share one query
+        while (inflight := self._inflight.get(key)) is not None:
+            try:
+                return await asyncio.shield(inflight)
+            except asyncio.CancelledError:
+                if not inflight.cancelled():
+                    raise
+                # only the caller running the query was cancelled, try again
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            result = await loader()
+            future.set_result(result)
+            return result
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # mark retrieved when nobody else was waiting
+            raise
+        finally:
+            # a cancelled leader must not leave the callers sharing its query waiting forever
+            if not future.done():
+                future.cancel()
+            del self._inflight[key]
+
+    async def _load_user(self, username: str) -> Optional[UserSnapshot]:
+        epoch = self._epoch
+        async with self.session_factory() as db:
+            if (user := await find_user(db, username)) is None:
+                return None
+            snapshot = UserSnapshot.from_model(user)
+            group = GroupSnapshot.from_model(user.groups[0]) if user.groups else None
+
+        if epoch == self._epoch:
+            self.users.set(username, snapshot)
+            if group is not None:
+                self.groups.set(group.group_id, group)
+        return snapshot
+
+    async def _load_group(self, group_id: str) -> Optional[GroupSnapshot]:
+        epoch = self._epoch
+        async with self.session_factory() as db:
+            result = await db.execute(
+                select(GroupModel).options(selectinload(GroupModel.users)).filter(GroupModel.group_id == group_id)
+            )
+            if (group := result.scalar_one_or_none()) is None:
+                return None
+            snapshot = GroupSnapshot.from_model(group)
+
+        if epoch == self._epoch:
+            self.groups.set(group_id, snapshot)
+        return snapshot
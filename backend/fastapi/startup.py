@@ -0,0 +1,66 @@
+import logging
+import time
+from typing import Any, Awaitable, Dict, Optional, Set
+
+
+log = logging.getLogger(__name__)
+
+
+class Startup:
+    """
+    Times the steps of app startup, which run concurrently, and tracks whether this worker should receive traffic.
+
+    The worker is ready once `finish` was called and every step started with `background` set has completed, so a
+    model still loading keeps it out of rotation without delaying the rest of startup. It stops being ready as soon
+    as shutdown begins, letting the load balancer drain it.
+    """
+
+    def __init__(self):
+        self.timings: Dict[str, float] = {}
+        self.errors: Dict[str, str] = {}
+        self.started = time.perf_counter()
+        self.finished: Optional[float] = None
+        self.stopping = False
+        self._waiting: Set[str] = set()
+
+    async def step(self, name: str, awaitable: Awaitable, background: bool = False) -> Any:
+        """
+        Await one startup step and record how long it took. Failures are recorded and raised again.
+        """
+        if background:
+            self._waiting.add(name)
+        started = time.perf_counter()
+        try:
+            return await awaitable
+        except Exception as e:
+            self.errors[name] = str(e)
+            raise
+        finally:
+            self.timings[name] = round(time.perf_counter() - started, 3)
+            self._waiting.discard(name)
+            if background and self.finished is not None:
+                log.info(f"startup step {name} finished after {self.timings[name]}s")
+
+    def finish(self):
+        self.finished = time.perf_counter()
+        steps = ", ".join(f"{name} {seconds}s" for name, seconds in self.timings.items())
+        waiting = f", still waiting for {', '.join(sorted(self._waiting))}" if self._waiting else ""
+        log.info(f"started in {self.total}s ({steps}){waiting}")
+
+    @property
+    def total(self) -> Optional[float]:
+        return None if self.finished is None else round(self.finished - self.started, 3)
+
+    @property
+    def ready(self) -> bool:
+        return self.finished is not None and not self._waiting and not self.stopping
+
+    def report(self) -> Dict[str, Any]:
+        return {
+            "ready": self.ready,
+            "stopping": self.stopping,
+            "startup_seconds": self.total,
+            "steps": dict(self.timings),
+            "waiting_for": sorted(self._waiting),
+            "errors": dict(self.errors)
+        }
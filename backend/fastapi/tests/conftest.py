@@ -0,0 +1,8 @@
+import os
+import sys
+import tempfile
+
+
+# the app modules import each other by name and database.py needs a URL at import time, the tests never use its engine
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DATABASE_URL", f"sqlite+aiosqlite:///{os.path.join(tempfile.gettempdir(), 'snuz-tests.db')}")
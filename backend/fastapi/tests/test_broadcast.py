@@ -0,0 +1,57 @@
+import datetime as dt
+import json
+
+from broadcast import MAX_NOTIFY_PAYLOAD, BroadcastBus, BroadcastMessage, PostgresBroadcastBus
+
+
+GROUP_ID = "4b7e2f7c-2d3a-4d0e-9f57-0c9a3c1b5e21"
+
+
+def sync_summary(events: int) -> BroadcastMessage:
+    start = dt.datetime(2026, 10, 18, 22, 0)
+    return BroadcastMessage(
+        "sync",
+        "snuz",
+        {
+            "events": [
+                {
+                    "username": f"member{i % 5}",
+                    "operation": ("to-sleep", "to-snooze", "to-awake")[i % 3],
+                    "timestamp": (start + dt.timedelta(minutes=i)).isoformat()
+                }
+                for i in range(events)
+            ],
+            "finished": False
+        },
+        presence={"asleep": ["member1"], "awake": ["member0", "member2"], "finished": False}
+    )
+
+
+def test_small_message_is_not_split():
+    bus = PostgresBroadcastBus("postgresql://unused")
+    summary = sync_summary(3)
+    assert summary.split("events", lambda payload: bus.fits(GROUP_ID, payload)) == [summary]
+
+
+def test_large_sync_summary_is_split_into_forwardable_parts():
+    bus = PostgresBroadcastBus("postgresql://unused")
+    summary = sync_summary(1000)
+    assert not bus.fits(GROUP_ID, summary.to_string())
+
+    parts = summary.split("events", lambda payload: bus.fits(GROUP_ID, payload))
+
+    assert len(parts) > 1
+    for part in parts:
+        payload = part.to_string()
+        assert bus.fits(GROUP_ID, payload)
+        assert len(bus._notification(GROUP_ID, payload).encode()) <= MAX_NOTIFY_PAYLOAD
+    assert [event for part in parts for event in part.data["events"]] == summary.data["events"]
+    assert [(part.data["part"], part.data["parts"]) for part in parts] == [(i + 1, len(parts)) for i in range(len(parts))]
+    # the presence delta is applied once, after every event it summarizes
+    assert [part.presence for part in parts[:-1]] == [None] * (len(parts) - 1)
+    assert json.loads(parts[-1].to_string())["presence"] == summary.presence
+
+
+def test_local_bus_sends_any_size_at_once():
+    summary = sync_summary(1000)
+    assert summary.split("events", lambda payload: BroadcastBus().fits(GROUP_ID, payload)) == [summary]
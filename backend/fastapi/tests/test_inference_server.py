@@ -0,0 +1,53 @@
+import asyncio
+import threading
+
+import pytest
+
+import inference
+from inference import InferenceWorker
+from inference_server import InferenceClient, serve
+
+
+async def eventually(condition, timeout: float = 5):
+    async with asyncio.timeout(timeout):
+        while not condition():
+            await asyncio.sleep(0.01)
+
+
+def test_request_cancelled_by_the_client_skips_the_forward_pass(tmp_path, monkeypatch):
+    generated = []
+    release = threading.Event()
+
+    def generator(prompts, **kwargs):
+        generated.extend(prompts)
+        if "first" in prompts:
+            release.wait(5)  # holds the worker thread so the next prompt has to queue
+        return inference.template_generator(prompts)
+
+    monkeypatch.setattr(inference, "stub_generator", generator)
+    socket_path = str(tmp_path / "inference.sock")
+
+    async def main():
+        worker = InferenceWorker("stub", batch_window=0)
+        worker.start()
+        server = asyncio.create_task(serve(socket_path, worker))
+        client = InferenceClient(socket_path, "stub", connect_timeout=5)
+        try:
+            first = asyncio.create_task(client.generate("first", 5))
+            await eventually(lambda: "first" in generated)
+
+            with pytest.raises(asyncio.TimeoutError):
+                await asyncio.wait_for(client.generate("second", 5), 0.1)
+            await eventually(lambda: all(request.future.cancelled() for request in list(worker._requests.queue)))
+            release.set()
+
+            assert await first == "first"
+            assert await client.generate("third", 5) == "third"
+        finally:
+            release.set()
+            client.stop()
+            server.cancel()
+            worker.stop(timeout=5)
+
+    asyncio.run(main())
+    assert generated == ["first", "third"]
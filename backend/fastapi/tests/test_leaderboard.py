@@ -0,0 +1,95 @@
+import random
+
+import pytest
+
+from leaderboard import Leaderboard, Leaderboards
+
+
+def ranking(scores: dict) -> list:
+    """
+    What a board holding `scores` should rank, worked out by sorting everything.
+    """
+    ordered = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+    return [{"rank": rank, "username": username, "score": score} for rank, (username, score) in enumerate(ordered, 1)]
+
+
+def filled(min_score: int, max_score: int, operations: int, seed: int):
+    rng = random.Random(seed)
+    board = Leaderboard(min_score, max_score)
+    scores = {}
+    for _ in range(operations):
+        username = f"user{rng.randrange(200)}"
+        if rng.random() < 0.2:
+            board.remove(username)
+            scores.pop(username, None)
+        else:
+            # scores past either end are clamped onto the board
+            score = rng.randint(min_score - 5, max_score + 5)
+            board.update(username, score)
+            scores[username] = min(max(score, min_score), max_score)
+    return board, scores
+
+
+@pytest.mark.parametrize("min_score, max_score, seed", [(0, 100, 1), (0, 100, 2), (0, 6, 3), (-3, 3, 4), (5, 5, 5)])
+def test_ranks_and_pages_match_a_full_sort(min_score, max_score, seed):
+    board, scores = filled(min_score, max_score, 2000, seed)
+    expected = ranking(scores)
+
+    assert len(board) == len(scores)
+    assert board.entries(1, len(scores)) == expected
+    for entry in expected:
+        assert board.rank(entry["username"]) == entry["rank"]
+        assert board.score(entry["username"]) == entry["score"]
+    for start in range(1, len(expected) + 2):
+        assert board.entries(start, 7) == expected[start - 1:start + 6]
+    assert board.top(10) == expected[:10]
+    username = expected[len(expected) // 2]["username"]
+    middle = len(expected) // 2
+    assert board.around(username, 3) == expected[max(middle - 3, 0):middle + 4]
+
+
+@pytest.mark.parametrize("seed", [1, 2, 3])
+def test_fenwick_tree_prefix_sums_and_descent(seed):
+    board, _ = filled(0, 50, 1000, seed)
+    sizes = [len(bucket) for bucket in board._buckets]
+
+    for index in range(len(sizes) + 1):
+        assert board._prefix(index) == sum(sizes[:index])
+    for rank in range(1, len(board) + 1):
+        index, offset = board._locate(rank)
+        assert sum(sizes[:index]) + offset == rank - 1
+        assert offset < sizes[index]
+
+
+def test_empty_board_and_unknown_users():
+    board = Leaderboard(0, 100)
+    assert board.entries(1, 5) == []
+    assert board.top(3) == []
+    assert board.rank("nobody") is None
+    assert board.around("nobody", 2) == []
+    board.remove("nobody")
+
+    board.update("alice", 50)
+    board.update("alice", 50)
+    assert board.entries(1, 5) == [{"rank": 1, "username": "alice", "score": 50}]
+    assert board.entries(2, 5) == []
+    assert board.entries(1, 0) == []
+
+
+def test_group_boards_follow_membership():
+    boards = Leaderboards(0, 100)
+    for username, score in (("alice", 80), ("bob", 90), ("carol", 70)):
+        boards.update(username, score)
+    boards.set_group("alice", "g")
+    boards.set_group("bob", "g")
+    boards.update("alice", 95)
+
+    assert [entry["username"] for entry in boards.board("g").top(5)] == ["alice", "bob"]
+    assert [entry["username"] for entry in boards.board().top(5)] == ["alice", "bob", "carol"]
+
+    boards.set_group("bob", None)
+    assert [entry["username"] for entry in boards.board("g").top(5)] == ["alice"]
+    boards.remove_group("g")
+    assert boards.board("g") is None
+    boards.update("alice", 10)
+    assert boards.board().rank("alice") == 3
@@ -0,0 +1,128 @@
+import asyncio
+import datetime as dt
+
+import pytest
+from sqlalchemy import insert, select
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from database import Base, GroupModel, UserModel, user_group_association
+from transitions import apply_wake_up, snooze, wake_up
+
+
+SLEEP_GOAL = dt.datetime(2026, 10, 18, 22, 0)
+WAKE_GOAL = dt.datetime(2026, 10, 19, 6, 0)
+
+
+def run(database, test):
+    """
+    Run `test(sessions)` against fresh tables in a SQLite file, on an event loop of its own.
+    """
+    async def main():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{database}", connect_args={"timeout": 30})
+        try:
+            async with engine.begin() as connection:
+                await connection.run_sync(Base.metadata.create_all)
+            return await test(async_sessionmaker(engine, expire_on_commit=False))
+        finally:
+            await engine.dispose()
+    return asyncio.run(main())
+
+
+def group_row(days_remaining: int = 3) -> dict:
+    return {
+        "group_id": "g",
+        "owner_username": None,
+        "to_sleep_time": SLEEP_GOAL,
+        "to_wake_up_time": WAKE_GOAL,
+        "duration_days": 3,
+        "days_remaining": days_remaining,
+        "start_date": SLEEP_GOAL.date()
+    }
+
+
+def user_row(username: str, **values) -> dict:
+    return {
+        "username": username,
+        "owns_a_group": False,
+        "score": 100,
+        "average_minutes_slept": None,
+        "is_asleep": True,
+        "last_sleep_time": SLEEP_GOAL,
+        "last_awake_time": None,
+        "current_snooze_counter": 0,
+        **values
+    }
+
+
+async def add_group(sessions, *members: dict, days_remaining: int = 3):
+    async with sessions() as db:
+        await db.execute(insert(UserModel.__table__), list(members))
+        await db.execute(insert(GroupModel.__table__), [group_row(days_remaining)])
+        await db.execute(insert(user_group_association), [
+            {"user_id": member["username"], "group_id": "g"} for member in members
+        ])
+        await db.commit()
+
+
+@pytest.mark.parametrize("values, awake_time", [
+    ({}, WAKE_GOAL),
+    ({"average_minutes_slept": 420}, WAKE_GOAL + dt.timedelta(minutes=37)),
+    ({"average_minutes_slept": 500, "current_snooze_counter": 3}, WAKE_GOAL - dt.timedelta(minutes=90)),
+    ({"score": 3, "current_snooze_counter": 9, "last_sleep_time": SLEEP_GOAL + dt.timedelta(hours=4)}, WAKE_GOAL),
+    ({"score": 99, "last_sleep_time": SLEEP_GOAL - dt.timedelta(hours=3)}, WAKE_GOAL + dt.timedelta(hours=2)),
+])
+def test_wake_up_scores_like_apply_wake_up(tmp_path, values, awake_time):
+    row = user_row("alice", **values)
+
+    async def test(sessions):
+        await add_group(sessions, row)
+        async with sessions() as db:
+            transition = await wake_up(db, "alice", awake_time)
+            await db.commit()
+        return transition
+
+    transition = run(tmp_path / "snuz.db", test)
+
+    user = UserModel(**row)
+    apply_wake_up(user, GroupModel(**group_row()), awake_time)
+    assert (transition.score, transition.average_minutes_slept) == (user.score, user.average_minutes_slept)
+
+
+def test_concurrent_snoozes_both_count(tmp_path):
+    async def test(sessions):
+        await add_group(sessions, user_row("alice"))
+
+        async def snooze_once():
+            async with sessions() as db:
+                transition = await snooze(db, "alice")
+                await db.commit()
+                return transition
+
+        transitions = await asyncio.gather(snooze_once(), snooze_once())
+        async with sessions() as db:
+            counter = await db.scalar(select(UserModel.current_snooze_counter))
+        return transitions, counter
+
+    transitions, counter = run(tmp_path / "snuz.db", test)
+    assert sorted(transition.snoozes for transition in transitions) == [1, 2]
+    assert counter == 2
+
+
+def test_group_advances_once_after_the_last_member_wakes_up(tmp_path):
+    async def test(sessions):
+        await add_group(sessions, user_row("alice"), user_row("bob"))
+        transitions = []
+        for username in ("alice", "bob", "bob"):
+            async with sessions() as db:
+                transitions.append(await wake_up(db, username, WAKE_GOAL))
+                await db.commit()
+        async with sessions() as db:
+            group = (await db.execute(select(GroupModel))).scalar_one()
+        return transitions, group
+
+    (alice, bob, again), group = run(tmp_path / "snuz.db", test)
+    assert not alice.group_advanced
+    assert bob.group_advanced and bob.days_remaining == 2
+    assert again is None
+    assert group.days_remaining == 2
+    assert group.to_sleep_time == bob.next_sleep_time > SLEEP_GOAL
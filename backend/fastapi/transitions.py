@@ -0,0 +1,360 @@
+from dataclasses import dataclass, field
+import datetime as dt
+import math
+from typing import Dict, List, Optional
+
+from sqlalchemy import Float, Integer, case, cast, delete, exists, func, literal, not_, or_, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.functions import FunctionElement
+
+from database import MAX_SCORE, MIN_SCORE, GroupModel, UserModel, user_group_association
+from scheduler import MISSED_SLEEP_WINDOW, next_group_times
+
+
+users = UserModel.__table__
+groups = GroupModel.__table__
+members = user_group_association
+
+
+class epoch(FunctionElement):
+    """
+    Seconds since the Unix epoch of a naive UTC timestamp column.
+    """
+    type = Float()
+    name = "epoch"
+    inherit_cache = True
+
+
+@compiles(epoch)
+def _epoch(element, compiler, **kw):
+    return f"EXTRACT(EPOCH FROM {compiler.process(element.clauses, **kw)})"
+
+
+@compiles(epoch, "sqlite")
+def _epoch_sqlite(element, compiler, **kw):
+    # julianday keeps milliseconds but its float is a few microseconds off, which would floor 240 minutes to 239
+    return f"round((julianday({compiler.process(element.clauses, **kw)}) - 2440587.5) * 86400.0, 3)"
+
+
+def _seconds(timestamp: dt.datetime) -> float:
+    return timestamp.replace(tzinfo=dt.timezone.utc).timestamp()
+
+
+in_a_group = exists().where(members.c.user_id == users.c.username)
+
+
+def group_of(username: str):
+    """
+    The group_id of `username`, as a subquery that never correlates with an outer user_group_association.
+    """
+    membership = members.alias("membership")
+    return select(membership.c.group_id).where(membership.c.user_id == username).scalar_subquery()
+
+
+@dataclass
+class Member:
+    username: str
+    is_asleep: bool
+
+
+@dataclass
+class Transition:
+    """
+    What one state change did, read back from the row it updated.
+    """
+    username: str
+    group_id: str
+    members: List[Member]
+    score: int
+    average_minutes_slept: Optional[int]
+    last_sleep_time: Optional[dt.datetime]
+    last_awake_time: Optional[dt.datetime]
+    snoozes: int
+    # filled in by wake_up for the night the user just finished
+    sleep_goal: Optional[dt.datetime] = None
+    wake_goal: Optional[dt.datetime] = None
+    days_remaining: Optional[int] = None
+    next_sleep_time: Optional[dt.datetime] = None
+    next_wake_up_time: Optional[dt.datetime] = None
+    group_advanced: bool = False
+    group_finished: bool = False
+    # members who never went to sleep that night, with their score after the penalty
+    penalized: Dict[str, int] = field(default_factory=dict)
+
+
+@dataclass
+class Advance:
+    """
+    A group moved on to its next night, `finished` when that was its last one and it was deleted.
+    """
+    days_remaining: int
+    next_sleep_time: Optional[dt.datetime]
+    next_wake_up_time: Optional[dt.datetime]
+    # members who never went to sleep that night, with their score after the penalty
+    penalized: Dict[str, int] = field(default_factory=dict)
+
+    @property
+    def finished(self) -> bool:
+        return self.days_remaining == 0
+
+
+RETURNED = (
+    users.c.username,
+    users.c.score,
+    users.c.average_minutes_slept,
+    users.c.last_sleep_time,
+    users.c.last_awake_time,
+    users.c.current_snooze_counter
+)
+
+
+async def fall_asleep(db: AsyncSession, username: str, now: dt.datetime) -> Optional[Transition]:
+    """
+    Mark an awake member asleep, or return None when the user is missing, not in a group or already asleep.
+    """
+    row = (await db.execute(
+        update(users)
+        .where(users.c.username == username, not_(users.c.is_asleep), in_a_group)
+        .values(is_asleep=True, last_sleep_time=now, last_awake_time=None, current_snooze_counter=0)
+        .returning(*RETURNED)
+    )).one_or_none()
+    if row is None:
+        return None
+    return await _with_members(db, row)
+
+
+async def snooze(db: AsyncSession, username: str) -> Optional[Transition]:
+    """
+    Count one more snooze for an asleep member, or return None when the user is missing, not in a group or awake.
+    Concurrent snoozes each add one since the increment happens in the database.
+    """
+    row = (await db.execute(
+        update(users)
+        .where(users.c.username == username, users.c.is_asleep, in_a_group)
+        .values(current_snooze_counter=users.c.current_snooze_counter + 1)
+        .returning(*RETURNED)
+    )).one_or_none()
+    if row is None:
+        return None
+    return await _with_members(db, row)
+
+
+async def wake_up(
+    db: AsyncSession,
+    username: str,
+    now: dt.datetime,
+    missed_sleep_penalty: int = 0
+) -> Optional[Transition]:
+    """
+    Wake an asleep member and score their night, moving the group on to its next night if they were the last one
+    asleep. Members who never went to sleep that night lose `missed_sleep_penalty` points when the group moves on,
+    by the same rule the scheduler applies at rollover. Returns None when the user is missing, not in a group or
+    already awake.
+
+    The group row is locked first so the members of a group wake up one at a time, which makes the check for
+    everyone being awake reliable. The score is computed from the user's row inside the UPDATE, and the snooze
+    counter is left as it was so the finished night's snoozes can be read back, /to-sleep resets it.
+    """
+    rows = (await db.execute(
+        select(
+            groups.c.group_id,
+            groups.c.to_sleep_time,
+            groups.c.to_wake_up_time,
+            groups.c.duration_days,
+            groups.c.days_remaining,
+            groups.c.start_date,
+            users.c.username,
+            users.c.is_asleep
+        )
+        .join(members, members.c.group_id == groups.c.group_id)
+        .join(users, users.c.username == members.c.user_id)
+        .where(groups.c.group_id == group_of(username))
+        .with_for_update(of=groups)
+    )).all()
+    if not rows:
+        return None
+    group = rows[0]
+
+    # same formula as before, only now evaluated against the row being updated
+    slept = epoch(users.c.last_sleep_time)
+    today_minutes_slept = func.floor((literal(_seconds(now)) - slept) / 60)
+    average_minutes_slept = case(
+        (users.c.average_minutes_slept.is_(None), today_minutes_slept),
+        else_=func.floor((users.c.average_minutes_slept + today_minutes_slept) / 2.0)
+    )
+    minutes_slept_diff = today_minutes_slept - average_minutes_slept
+    to_sleep_diff = func.floor((literal(_seconds(group.to_sleep_time)) - slept) / 300)
+    to_awake_diff = math.floor((_seconds(now) - _seconds(group.to_wake_up_time)) / 300)
+    diff_summary = minutes_slept_diff + to_sleep_diff + to_awake_diff
+    score = func.floor(users.c.score + diff_summary * 0.2 - users.c.current_snooze_counter)
+
+    row = (await db.execute(
+        update(users)
+        .where(users.c.username == username, users.c.is_asleep)
+        .values(
+            is_asleep=False,
+            last_awake_time=now,
+            average_minutes_slept=cast(average_minutes_slept, Integer),
+            score=cast(case((score < MIN_SCORE, MIN_SCORE), (score > MAX_SCORE, MAX_SCORE), else_=score), Integer)
+        )
+        .returning(*RETURNED)
+    )).one_or_none()
+    if row is None:
+        return None
+
+    transition = Transition(
+        username=row.username,
+        group_id=group.group_id,
+        members=[Member(r.username, r.is_asleep and r.username != username) for r in rows],
+        score=row.score,
+        average_minutes_slept=row.average_minutes_slept,
+        last_sleep_time=row.last_sleep_time,
+        last_awake_time=row.last_awake_time,
+        snoozes=row.current_snooze_counter,
+        sleep_goal=group.to_sleep_time,
+        wake_goal=group.to_wake_up_time
+    )
+    if any(member.is_asleep for member in transition.members):
+        return transition
+
+    advance = await advance_group(
+        db, group, [member.username for member in transition.members], missed_sleep_penalty
+    )
+    if advance is None:
+        return transition
+    transition.group_advanced = True
+    transition.days_remaining = advance.days_remaining
+    transition.penalized = advance.penalized
+    transition.group_finished = advance.finished
+    transition.next_sleep_time = advance.next_sleep_time
+    transition.next_wake_up_time = advance.next_wake_up_time
+    return transition
+
+
+def apply_wake_up(user: UserModel, group: GroupModel, awake_time: dt.datetime):
+    """
+    Wake an asleep user loaded in the session at `awake_time`, scoring the night against the group's goals.
+    The same formula as wake_up, for batches that work on loaded rows.
+    """
+    user.is_asleep = False
+    user.last_awake_time = awake_time
+
+    to_sleep_goal = group.to_sleep_time.replace(tzinfo=dt.timezone.utc)
+    to_awake_goal = group.to_wake_up_time.replace(tzinfo=dt.timezone.utc)
+
+    last_sleep_time = user.last_sleep_time.replace(tzinfo=dt.timezone.utc)
+    last_awake_time = user.last_awake_time.replace(tzinfo=dt.timezone.utc)
+    today_minutes_slept = int((last_awake_time - last_sleep_time).total_seconds() // 60)
+
+    if user.average_minutes_slept is None:
+        user.average_minutes_slept = today_minutes_slept
+    else:
+        user.average_minutes_slept = (user.average_minutes_slept + today_minutes_slept) // 2
+
+    minutes_slept_diff = today_minutes_slept - user.average_minutes_slept # if positive, slept more than avg. if negative, slept less than avg.
+    to_sleep_diff = int((to_sleep_goal - last_sleep_time).total_seconds() // (60 * 5))
+    to_awake_diff = int((last_awake_time - to_awake_goal).total_seconds() // (60 * 5))
+    diff_summary = minutes_slept_diff + to_sleep_diff + to_awake_diff
+
+    user.score = min(max(math.floor(user.score + (diff_summary * 0.2) - user.current_snooze_counter), MIN_SCORE), MAX_SCORE)
+
+
+async def advance_group(
+    db: AsyncSession,
+    group,
+    usernames: List[str],
+    missed_sleep_penalty: int = 0
+) -> Optional[Advance]:
+    """
+    Move `group` on to its next night if none of its members is asleep in the database, or delete it once the
+    challenge is over. `group` is the group's row or model as it was read under its lock, `usernames` its members.
+    Members who never went to sleep that night lose `missed_sleep_penalty` points, by the same rule the scheduler
+    applies at rollover. Returns None when someone is asleep, the caller commits.
+    """
+    # members who never went to sleep count as awake here and are penalized below once the group moves on
+    #! Feature not bug. If someone does not sleep, by the time everyone else wakes up, then to bad.
+    days_remaining = group.days_remaining - 1
+    values = {"days_remaining": days_remaining}
+    if days_remaining != 0:
+        values["to_sleep_time"], values["to_wake_up_time"] = next_group_times(
+            group.start_date,
+            group.duration_days,
+            days_remaining,
+            group.to_sleep_time,
+            group.to_wake_up_time
+        )
+    nobody_asleep = not_(
+        exists()
+        .where(members.c.group_id == groups.c.group_id, members.c.user_id == users.c.username, users.c.is_asleep)
+    )
+    advanced = (await db.execute(
+        update(groups)
+        .where(groups.c.group_id == group.group_id, nobody_asleep)
+        .values(**values)
+        .returning(groups.c.group_id)
+    )).one_or_none()
+    if advanced is None:
+        return None
+
+    advance = Advance(days_remaining, values.get("to_sleep_time"), values.get("to_wake_up_time"))
+    if missed_sleep_penalty:
+        penalized = await db.execute(
+            update(users)
+            .where(
+                users.c.username.in_(usernames),
+                or_(
+                    users.c.last_sleep_time.is_(None),
+                    users.c.last_sleep_time < group.to_sleep_time - MISSED_SLEEP_WINDOW
+                )
+            )
+            .values(
+                score=case(
+                    (users.c.score - missed_sleep_penalty < MIN_SCORE, MIN_SCORE),
+                    else_=users.c.score - missed_sleep_penalty
+                ),
+                current_snooze_counter=0
+            )
+            .returning(users.c.username, users.c.score)
+        )
+        advance.penalized = dict(penalized.all())
+    if days_remaining == 0: # end of sleep challenge
+        await db.execute(delete(members).where(members.c.group_id == group.group_id))
+        await db.execute(delete(groups).where(groups.c.group_id == group.group_id))
+    return advance
+
+
+async def rejection(db: AsyncSession, username: str) -> str:
+    """
+    Why a transition for `username` matched no row.
+    """
+    row = (await db.execute(
+        select(users.c.is_asleep, in_a_group).where(users.c.username == username)
+    )).one_or_none()
+    if row is None:
+        return f"User does not exist: {username}"
+    is_asleep, grouped = row
+    if not grouped:
+        return f"{username} is not in a group"
+    if is_asleep:
+        return f"{username} is already asleep!"
+    return f"{username} is not asleep yet!"
+
+
+async def _with_members(db: AsyncSession, row) -> Transition:
+    result = await db.execute(
+        select(members.c.group_id, users.c.username, users.c.is_asleep)
+        .join(users, users.c.username == members.c.user_id)
+        .where(members.c.group_id == group_of(row.username))
+    )
+    rows = result.all()
+    return Transition(
+        username=row.username,
+        group_id=rows[0].group_id,
+        members=[Member(r.username, r.is_asleep) for r in rows],
+        score=row.score,
+        average_minutes_slept=row.average_minutes_slept,
+        last_sleep_time=row.last_sleep_time,
+        last_awake_time=row.last_awake_time,
+        snoozes=row.current_snooze_counter
+    )